@@ -49,98 +49,133 @@ import csv
 from io import BytesIO
 import numpy as np
 import nibabel as nib
-from GetFilename import GetFilename
 from PIL import Image
 from fpdf import FPDF
 from fpdf import __version__ as fpdf_version
+from hippodeep_output import subject_base
+
+
+# color lookup tables, built once when the module is imported
+
+lut_gray = np.zeros ([256,3], dtype=np.uint8)
+lut_gray  [:,0] = np.linspace(0, 255, num=256, endpoint=True)
+lut_gray  [:,1] = lut_gray  [:,0]
+lut_gray  [:,2] = lut_gray  [:,0]
+lut_gray = lut_gray.astype(np.uint8)
+
+lut_red  = np.zeros ([256,3], dtype=np.uint8)
+lut_red [:,0] = np.linspace(0, 255, num=256, endpoint=True)
+lut_red = lut_red.astype(np.uint8)
+
+lut_green = np.zeros ([256,3], dtype=np.uint8)
+lut_green[:,1] = np.linspace(0, 255, num=256, endpoint=True)
+lut_green = lut_green.astype(np.uint8)
+
+lut_blue = np.zeros ([256,3], dtype=np.uint8)
+lut_blue[:,2] = np.linspace(0, 255, num=256, endpoint=True)
+lut_blue = lut_blue.astype(np.uint8)
+
+lut_yellow  = np.zeros ([256,3], dtype=np.uint8)
+lut_yellow [:,0] = np.linspace(0, 255, num=256, endpoint=True)
+lut_yellow [:,1] = lut_yellow [:,0]
+lut_yellow = lut_yellow.astype(np.uint8)
+
+lut_magenta = np.zeros ([256,3], dtype=np.uint8)
+lut_magenta [:,0] = np.linspace(0, 255, num=256, endpoint=True)
+lut_magenta [:,2] = lut_magenta [:,0]
+lut_magenta = lut_magenta.astype(np.uint8)
+
+lut_cyan = np.zeros ([256,3], dtype=np.uint8)
+lut_cyan [:,1] = np.linspace(0, 255, num=256, endpoint=True)
+lut_cyan [:,2] = lut_cyan [:,1]
+lut_cyan = lut_cyan.astype(np.uint8)
+
+#http://dicom.nema.org/medical/dicom/current/output/chtml/part06/chapter_B.html#sect_B.1.1
+lut_hotiron = np.asarray([
+[ 0, 0,0],[ 2, 0,0],[ 4, 0,0],[ 6, 0,0],[ 8, 0,0],[ 10,0,0],[ 12,0,0],[ 14,0,0],
+[ 16,0,0],[ 18,0,0],[ 20,0,0],[ 22,0,0],[ 24,0,0],[ 26,0,0],[ 28,0,0],[ 30,0,0],
+[ 32,0,0],[ 34,0,0],[ 36,0,0],[ 38,0,0],[ 40,0,0],[ 42,0,0],[ 44,0,0],[ 46,0,0],
+[ 48,0,0],[ 50,0,0],[ 52,0,0],[ 54,0,0],[ 56,0,0],[ 58,0,0],[ 60,0,0],[ 62,0,0],
+[ 64,0,0],[ 66,0,0],[ 68,0,0],[ 70,0,0],[ 72,0,0],[ 74,0,0],[ 76,0,0],[ 78,0,0],
+[ 80,0,0],[ 82,0,0],[ 84,0,0],[ 86,0,0],[ 88,0,0],[ 90,0,0],[ 92,0,0],[ 94,0,0],
+[ 96,0,0],[ 98,0,0],[100,0,0],[102,0,0],[104,0,0],[106,0,0],[108,0,0],[110,0,0],
+[112,0,0],[114,0,0],[116,0,0],[118,0,0],[120,0,0],[122,0,0],[124,0,0],[126,0,0],
+[128,0,0],[130,0,0],[132,0,0],[134,0,0],[136,0,0],[138,0,0],[140,0,0],[142,0,0],
+[144,0,0],[146,0,0],[148,0,0],[150,0,0],[152,0,0],[154,0,0],[156,0,0],[158,0,0],
+[160,0,0],[162,0,0],[164,0,0],[166,0,0],[168,0,0],[170,0,0],[172,0,0],[174,0,0],
+[176,0,0],[178,0,0],[180,0,0],[182,0,0],[184,0,0],[186,0,0],[188,0,0],[190,0,0],
+[192,0,0],[194,0,0],[196,0,0],[198,0,0],[200,0,0],[202,0,0],[204,0,0],[206,0,0],
+[208,0,0],[210,0,0],[212,0,0],[214,0,0],[216,0,0],[218,0,0],[220,0,0],[222,0,0],
+[224,0,0],[226,0,0],[228,0,0],[230,0,0],[232,0,0],[234,0,0],[236,0,0],[238,0,0],
+[240,0,0],[242,0,0],[244,0,0],[246,0,0],[248,0,0],[250,0,0],[252,0,0],[254,0,0],
+[255, 0, 0],[255, 2, 0],[255, 4, 0],[255, 6, 0],[255, 8, 0],[255, 10,0],[255, 12,0],[255, 14,0],
+[255, 16,0],[255, 18,0],[255, 20,0],[255, 22,0],[255, 24,0],[255, 26,0],[255, 28,0],[255, 30,0],
+[255, 32,0],[255, 34,0],[255, 36,0],[255, 38,0],[255, 40,0],[255, 42,0],[255, 44,0],[255, 46,0],
+[255, 48,0],[255, 50,0],[255, 52,0],[255, 54,0],[255, 56,0],[255, 58,0],[255, 60,0],[255, 62,0],
+[255, 64,0],[255, 66,0],[255, 68,0],[255, 70,0],[255, 72,0],[255, 74,0],[255, 76,0],[255, 78,0],
+[255, 80,0],[255, 82,0],[255, 84,0],[255, 86,0],[255, 88,0],[255, 90,0],[255, 92,0],[255, 94,0],
+[255, 96,0],[255, 98,0],[255,100,0],[255,102,0],[255,104,0],[255,106,0],[255,108,0],[255,110,0],
+[255,112,0],[255,114,0],[255,116,0],[255,118,0],[255,120,0],[255,122,0],[255,124,0],[255,126,0],
+[255,128,  4],[255,130,  8],[255,132, 12],[255,134, 16],[255,136, 20],[255,138, 24],[255,140, 28],[255,142, 32],
+[255,144, 36],[255,146, 40],[255,148, 44],[255,150, 48],[255,152, 52],[255,154, 56],[255,156, 60],[255,158, 64],
+[255,160, 68],[255,162, 72],[255,164, 76],[255,166, 80],[255,168, 84],[255,170, 88],[255,172, 92],[255,174, 96],
+[255,176,100],[255,178,104],[255,180,108],[255,182,112],[255,184,116],[255,186,120],[255,188,124],[255,190,128],
+[255,192,132],[255,194,136],[255,196,140],[255,198,144],[255,200,148],[255,202,152],[255,204,156],[255,206,160],
+[255,208,164],[255,210,168],[255,212,172],[255,214,176],[255,216,180],[255,218,184],[255,220,188],[255,222,192],
+[255,224,196],[255,226,200],[255,228,204],[255,230,208],[255,232,212],[255,234,216],[255,236,220],[255,238,224],
+[255,240,228],[255,242,232],[255,244,236],[255,246,240],[255,248,244],[255,250,248],[255,252,252],[255,255,255]])
+lut_hotiron = lut_hotiron.astype(np.uint8)
+
+lut_rediron = lut_hotiron # alias
+
+lut_greeniron  = np.zeros ([256,3], dtype=np.uint8)
+lut_greeniron [:,0] = lut_hotiron [:,2]    
+lut_greeniron [:,1] = lut_hotiron [:,0]  
+lut_greeniron [:,2] = lut_hotiron [:,1] 
+
+lut_blueiron  = np.zeros ([256,3], dtype=np.uint8)
+lut_blueiron [:,0] = lut_hotiron [:,2]    
+lut_blueiron [:,1] = lut_hotiron [:,1]  
+lut_blueiron [:,2] = lut_hotiron [:,0]  
+
+
+def blend(dst, rgb, alpha):
+    " alpha-blend the rgb images over dst (uint32) in place, with the rounding of PIL's Image.paste(img, (0,0), img) "
+    a = alpha[..., None].astype(np.uint32)
+    tmp = dst * (255 - a) + rgb * a + 128
+    dst[...] = ((tmp >> 8) + tmp) >> 8
+
+def render_slices(slices0, max0, overlays, lut_gray, transparancy):
+    """
+    The RGB (uint8) images of a stack of slices (k, h, w) of the T1, with
+    the (slices, max, lut) overlays blended over them in that order, each
+    with an alpha proportional to its value. The intensities are scaled by
+    the maxima of the whole volumes, given once for all the slices.
+    """
+    dst = lut_gray[(slices0/max0*255).astype(np.uint8)].astype(np.uint32)
+    for slices, vmax, lut in overlays:
+        value = slices/vmax*255
+        blend(dst, lut[value.astype(np.uint8)], (value*transparancy).astype(np.uint8))
+    return dst.astype(np.uint8)
+
+def add_image(pdf, rgb, tempname, x, y, w, h):
+    " place an RGB image on the PDF page, as a PNG "
+    img = Image.fromarray(rgb)
+    if fpdf_version<"2": #old version, write on disk
+      tempfile = tempname
+      img.save(tempfile)
+    else: #new version, write in memory
+      tempfile = BytesIO()
+      img.save(tempfile, 'png')
+      tempfile.name = 'test.png'
+      tempfile.seek(0)
+    pdf.image(tempfile, x = x, y=y, w = w, h=h, type="png")
+    if fpdf_version<"2": os.remove(tempfile) #old version, delete tempfile
 
 
 
 def HippoDeepReport(SpatResol, data0, data1, data2, data3, text0, text1, text2, text3, filename):
     
-    #define some color lookup tables    
-        
-    lut_gray = np.zeros ([256,3], dtype=np.uint8)
-    lut_gray  [:,0] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_gray  [:,1] = lut_gray  [:,0]
-    lut_gray  [:,2] = lut_gray  [:,0]
-    lut_gray = lut_gray.astype(np.uint8)
-
-    lut_red  = np.zeros ([256,3], dtype=np.uint8)
-    lut_red [:,0] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_red = lut_red.astype(np.uint8)
-
-    lut_green = np.zeros ([256,3], dtype=np.uint8)
-    lut_green[:,1] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_green = lut_green.astype(np.uint8)
-
-    lut_blue = np.zeros ([256,3], dtype=np.uint8)
-    lut_blue[:,2] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_blue = lut_blue.astype(np.uint8)
-
-    lut_yellow  = np.zeros ([256,3], dtype=np.uint8)
-    lut_yellow [:,0] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_yellow [:,1] = lut_yellow [:,0]
-    lut_yellow = lut_yellow.astype(np.uint8)
-
-    lut_magenta = np.zeros ([256,3], dtype=np.uint8)
-    lut_magenta [:,0] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_magenta [:,2] = lut_magenta [:,0]
-    lut_magenta = lut_magenta.astype(np.uint8)
-
-    lut_cyan = np.zeros ([256,3], dtype=np.uint8)
-    lut_cyan [:,1] = np.linspace(0, 255, num=256, endpoint=True)
-    lut_cyan [:,2] = lut_cyan [:,1]
-    lut_cyan = lut_cyan.astype(np.uint8)
-
-    #http://dicom.nema.org/medical/dicom/current/output/chtml/part06/chapter_B.html#sect_B.1.1
-    lut_hotiron = np.asarray([
-    [ 0, 0,0],[ 2, 0,0],[ 4, 0,0],[ 6, 0,0],[ 8, 0,0],[ 10,0,0],[ 12,0,0],[ 14,0,0],
-    [ 16,0,0],[ 18,0,0],[ 20,0,0],[ 22,0,0],[ 24,0,0],[ 26,0,0],[ 28,0,0],[ 30,0,0],
-    [ 32,0,0],[ 34,0,0],[ 36,0,0],[ 38,0,0],[ 40,0,0],[ 42,0,0],[ 44,0,0],[ 46,0,0],
-    [ 48,0,0],[ 50,0,0],[ 52,0,0],[ 54,0,0],[ 56,0,0],[ 58,0,0],[ 60,0,0],[ 62,0,0],
-    [ 64,0,0],[ 66,0,0],[ 68,0,0],[ 70,0,0],[ 72,0,0],[ 74,0,0],[ 76,0,0],[ 78,0,0],
-    [ 80,0,0],[ 82,0,0],[ 84,0,0],[ 86,0,0],[ 88,0,0],[ 90,0,0],[ 92,0,0],[ 94,0,0],
-    [ 96,0,0],[ 98,0,0],[100,0,0],[102,0,0],[104,0,0],[106,0,0],[108,0,0],[110,0,0],
-    [112,0,0],[114,0,0],[116,0,0],[118,0,0],[120,0,0],[122,0,0],[124,0,0],[126,0,0],
-    [128,0,0],[130,0,0],[132,0,0],[134,0,0],[136,0,0],[138,0,0],[140,0,0],[142,0,0],
-    [144,0,0],[146,0,0],[148,0,0],[150,0,0],[152,0,0],[154,0,0],[156,0,0],[158,0,0],
-    [160,0,0],[162,0,0],[164,0,0],[166,0,0],[168,0,0],[170,0,0],[172,0,0],[174,0,0],
-    [176,0,0],[178,0,0],[180,0,0],[182,0,0],[184,0,0],[186,0,0],[188,0,0],[190,0,0],
-    [192,0,0],[194,0,0],[196,0,0],[198,0,0],[200,0,0],[202,0,0],[204,0,0],[206,0,0],
-    [208,0,0],[210,0,0],[212,0,0],[214,0,0],[216,0,0],[218,0,0],[220,0,0],[222,0,0],
-    [224,0,0],[226,0,0],[228,0,0],[230,0,0],[232,0,0],[234,0,0],[236,0,0],[238,0,0],
-    [240,0,0],[242,0,0],[244,0,0],[246,0,0],[248,0,0],[250,0,0],[252,0,0],[254,0,0],
-    [255, 0, 0],[255, 2, 0],[255, 4, 0],[255, 6, 0],[255, 8, 0],[255, 10,0],[255, 12,0],[255, 14,0],
-    [255, 16,0],[255, 18,0],[255, 20,0],[255, 22,0],[255, 24,0],[255, 26,0],[255, 28,0],[255, 30,0],
-    [255, 32,0],[255, 34,0],[255, 36,0],[255, 38,0],[255, 40,0],[255, 42,0],[255, 44,0],[255, 46,0],
-    [255, 48,0],[255, 50,0],[255, 52,0],[255, 54,0],[255, 56,0],[255, 58,0],[255, 60,0],[255, 62,0],
-    [255, 64,0],[255, 66,0],[255, 68,0],[255, 70,0],[255, 72,0],[255, 74,0],[255, 76,0],[255, 78,0],
-    [255, 80,0],[255, 82,0],[255, 84,0],[255, 86,0],[255, 88,0],[255, 90,0],[255, 92,0],[255, 94,0],
-    [255, 96,0],[255, 98,0],[255,100,0],[255,102,0],[255,104,0],[255,106,0],[255,108,0],[255,110,0],
-    [255,112,0],[255,114,0],[255,116,0],[255,118,0],[255,120,0],[255,122,0],[255,124,0],[255,126,0],
-    [255,128,  4],[255,130,  8],[255,132, 12],[255,134, 16],[255,136, 20],[255,138, 24],[255,140, 28],[255,142, 32],
-    [255,144, 36],[255,146, 40],[255,148, 44],[255,150, 48],[255,152, 52],[255,154, 56],[255,156, 60],[255,158, 64],
-    [255,160, 68],[255,162, 72],[255,164, 76],[255,166, 80],[255,168, 84],[255,170, 88],[255,172, 92],[255,174, 96],
-    [255,176,100],[255,178,104],[255,180,108],[255,182,112],[255,184,116],[255,186,120],[255,188,124],[255,190,128],
-    [255,192,132],[255,194,136],[255,196,140],[255,198,144],[255,200,148],[255,202,152],[255,204,156],[255,206,160],
-    [255,208,164],[255,210,168],[255,212,172],[255,214,176],[255,216,180],[255,218,184],[255,220,188],[255,222,192],
-    [255,224,196],[255,226,200],[255,228,204],[255,230,208],[255,232,212],[255,234,216],[255,236,220],[255,238,224],
-    [255,240,228],[255,242,232],[255,244,236],[255,246,240],[255,248,244],[255,250,248],[255,252,252],[255,255,255]])
-    lut_hotiron = lut_hotiron.astype(np.uint8)
-
-    lut_rediron = lut_hotiron # alias
-
-    lut_greeniron  = np.zeros ([256,3], dtype=np.uint8)
-    lut_greeniron [:,0] = lut_hotiron [:,2]    
-    lut_greeniron [:,1] = lut_hotiron [:,0]  
-    lut_greeniron [:,2] = lut_hotiron [:,1] 
-
-    lut_blueiron  = np.zeros ([256,3], dtype=np.uint8)
-    lut_blueiron [:,0] = lut_hotiron [:,2]    
-    lut_blueiron [:,1] = lut_hotiron [:,1]  
-    lut_blueiron [:,2] = lut_hotiron [:,0]  
-
     transparancy = 0.4 # 0.5 is half-transparent, 1.0 is not-transparent 
     lut_left = lut_green
     lut_right = lut_red
@@ -203,12 +238,10 @@ def HippoDeepReport(SpatResol, data0, data1, data2, data3, text0, text1, text2,
     SpatResol[1], SpatResol[0] = SpatResol[0], SpatResol[1]
 
     # find all slices that contain some part of either ROI 
-    slices=[]; npoints=[]
     thresh = int(0.001*data0.shape[0]*data0.shape[1])
-    for slice in range (0,data0.shape[2]):
-      nz1=np.nonzero(data1[:,:,slice])
-      nz2=np.nonzero(data2[:,:,slice])
-      if len(nz1[0])>thresh and len(nz2[0])>thresh: slices.append(slice); npoints.append(len(nz1[0]))
+    nz1 = np.count_nonzero(data1, axis=(0,1))
+    nz2 = np.count_nonzero(data2, axis=(0,1))
+    slices = list(np.nonzero((nz1>thresh) & (nz2>thresh))[0])
       
     # choose a subset of these slices
     if len(slices)>2*slice_per_line: 
@@ -224,49 +257,13 @@ def HippoDeepReport(SpatResol, data0, data1, data2, data3, text0, text1, text2,
       slices = slices [0:target]
        
     height=width * data0.shape[0]/data0.shape[1] * SpatResol[0]/SpatResol[1]
-    i=0; ypos=yoffset    
-    for slice in slices:
-        imgdata0 = data0[:,:,slice]/np.max(data0)*255
-        imgdata0 = imgdata0.astype(np.uint8)
-        imgdata0  = lut_gray[imgdata0]
-        imgdata0 = np.append (imgdata0, np.zeros([imgdata0.shape[0],imgdata0.shape[1],1], dtype=np.uint8),axis=2)
-        imgdata0[:,:,3]=255 # but don't use it
-        img0 = Image.fromarray(imgdata0)
-        
-        imgdata1 = data1[:,:,slice]/np.max(data1)*255
-        imgdata1 = imgdata1.astype(np.uint8)
-        imgdata1  = lut_left[imgdata1]
-        imgdata1 = np.append (imgdata1, np.zeros([imgdata1.shape[0],imgdata1.shape[1],1], dtype=np.uint8),axis=2)
-        alpha = data1[:,:,slice]/np.max(data1)*255*transparancy
-        alpha = alpha.astype(np.uint8)
-        imgdata1[:,:,3] = alpha 
-        img1 = Image.fromarray(imgdata1)
-
-        imgdata2 = data2[:,:,slice]/np.max(data2)*255
-        imgdata2 = imgdata2.astype(np.uint8)
-        imgdata2  = lut_right[imgdata2]
-        imgdata2 = np.append (imgdata2, np.zeros([imgdata2.shape[0],imgdata2.shape[1],1], dtype=np.uint8),axis=2)
-        alpha = data2[:,:,slice]/np.max(data2)*255*transparancy
-        alpha = alpha.astype(np.uint8)
-        imgdata2[:,:,3] = alpha 
-        img2 = Image.fromarray(imgdata2)    
-        
-        img0.paste(img1, (0,0), img1)
-        img0.paste(img2, (0,0), img2)
-        img0 = img0.convert ("RGB") # remove alpha channel
-        if fpdf_version<"2": #old version, write on disk
-          tempfile = '.overlay_axi'+str(slice)+'.png'
-          img0.save(tempfile)
-        else: #new version, write in memory
-          tempfile = BytesIO()
-          img0.save(tempfile, 'png')
-          tempfile.name = 'test.png'
-          tempfile.seek(0)
+    take = lambda data: np.moveaxis(data[:,:,slices], 2, 0)
+    images = render_slices(take(data0), np.max(data0), [(take(data1), np.max(data1), lut_left), (take(data2), np.max(data2), lut_right)], lut_gray, transparancy)
+    ypos=yoffset    
+    for i, slice in enumerate(slices):
         xpos=(i%slice_per_line)*width + xoffset
         ypos=int(i/slice_per_line)*height + yoffset
-        pdf.image(tempfile, x = xpos, y=ypos, w = width, h=height, type="png")
-        if fpdf_version<"2": os.remove(tempfile) #old version, delete tempfile    
-        i += 1
+        add_image(pdf, images[i], '.overlay_axi'+str(slice)+'.png', xpos, ypos, width, height)
 
     yoffset=ypos+height+sparator
 
@@ -286,12 +283,10 @@ def HippoDeepReport(SpatResol, data0, data1, data2, data3, text0, text1, text2,
     SpatResol[2], SpatResol[1] = SpatResol[1], SpatResol[2]
 
     # find all slices that contain some part of either ROI 
-    slices=[]; npoints=[]
     thresh = int(0.001*data0.shape[1]*data0.shape[2])
-    for slice in range (0,data0.shape[0]):
-      nz1=np.nonzero(data1[slice,:,:])
-      nz2=np.nonzero(data2[slice,:,:])
-      if len(nz1[0])>thresh and len(nz2[0])>thresh: slices.append(slice); npoints.append(len(nz1[0]))
+    nz1 = np.count_nonzero(data1, axis=(1,2))
+    nz2 = np.count_nonzero(data2, axis=(1,2))
+    slices = list(np.nonzero((nz1>thresh) & (nz2>thresh))[0])
       
     # choose a subset of these slices
     if len(slices)>2*slice_per_line: 
@@ -307,50 +302,13 @@ def HippoDeepReport(SpatResol, data0, data1, data2, data3, text0, text1, text2,
       slices = slices [0:target]
      
     height=width * data0.shape[1]/data0.shape[2] * SpatResol[1]/SpatResol[2]
-    i=0; ypos=yoffset     
-    for slice in slices:
-        imgdata0 = data0[slice,:,:]/np.max(data0)*255
-        imgdata0 = imgdata0.astype(np.uint8)
-        imgdata0  = lut_gray[imgdata0]
-        imgdata0 = np.append (imgdata0, np.zeros([imgdata0.shape[0],imgdata0.shape[1],1], dtype=np.uint8),axis=2)
-        imgdata0[:,:,3]=255 # but don't use it
-        img0 = Image.fromarray(imgdata0)
-        
-        imgdata1 = data1[slice,:,:]/np.max(data1)*255
-        imgdata1 = imgdata1.astype(np.uint8)
-        imgdata1  = lut_left[imgdata1]
-        imgdata1 = np.append (imgdata1, np.zeros([imgdata1.shape[0],imgdata1.shape[1],1], dtype=np.uint8),axis=2)
-        alpha = data1[slice,:,:]/np.max(data1)*255*transparancy
-        alpha = alpha.astype(np.uint8)
-        imgdata1[:,:,3] = alpha 
-        img1 = Image.fromarray(imgdata1)
-
-        imgdata2 = data2[slice,:,:]/np.max(data2)*255
-        imgdata2 = imgdata2.astype(np.uint8)
-        imgdata2  = lut_right[imgdata2]
-        imgdata2 = np.append (imgdata2, np.zeros([imgdata2.shape[0],imgdata2.shape[1],1], dtype=np.uint8),axis=2)
-        alpha = data2[slice,:,:]/np.max(data2)*255*transparancy
-        alpha = alpha.astype(np.uint8)
-        imgdata2[:,:,3] = alpha 
-        img2 = Image.fromarray(imgdata2)    
-        
-        
-        img0.paste(img1, (0,0), img1)
-        img0.paste(img2, (0,0), img2)
-        img0 = img0.convert ("RGB") # remove alpha channel
-        if fpdf_version<"2": #old version, write on disk
-          tempfile = '.overlay_cor'+str(slice)+'.png'
-          img0.save(tempfile)
-        else: #new version, write in memory
-          tempfile = BytesIO()
-          img0.save(tempfile, 'png')
-          tempfile.name = 'test.png'
-          tempfile.seek(0)    
+    take = lambda data: data[slices,:,:]
+    images = render_slices(take(data0), np.max(data0), [(take(data1), np.max(data1), lut_left), (take(data2), np.max(data2), lut_right)], lut_gray, transparancy)
+    ypos=yoffset     
+    for i, slice in enumerate(slices):
         xpos=(i%slice_per_line)*width + xoffset
         ypos=int(i/slice_per_line)*height + yoffset
-        pdf.image(tempfile, x = xpos, y=ypos, w = width, h=height, type="png")
-        if fpdf_version<"2": os.remove(tempfile) #old version, delete tempfile  
-        i += 1
+        add_image(pdf, images[i], '.overlay_cor'+str(slice)+'.png', xpos, ypos, width, height)
         
     yoffset=ypos+height+sparator 
 
@@ -363,11 +321,10 @@ def HippoDeepReport(SpatResol, data0, data1, data2, data3, text0, text1, text2,
     SpatResol[1], SpatResol[0] = SpatResol[0], SpatResol[1]
 
     # find all slices that contain some part of either ROI 
-    slices=[]; npoints=[]
     thresh = int(0.001*data0.shape[0]*data0.shape[1])
-    for slice in range (0,data0.shape[2]):
-      nz2=np.nonzero(data2[:,:,slice])
-      if len(nz2[0])>thresh: slices.append(slice); npoints.append(len(nz1[0]))
+    nz1 = np.count_nonzero(data1, axis=(0,1))
+    nz2 = np.count_nonzero(data2, axis=(0,1))
+    slices = list(np.nonzero(nz2>thresh)[0])
       
     # choose a subset of these slices
     if len(slices)>slice_per_line:
@@ -381,52 +338,21 @@ def HippoDeepReport(SpatResol, data0, data1, data2, data3, text0, text1, text2,
       slices = slices [0:target]
 
     height=width * data0.shape[0]/data0.shape[1] * SpatResol[0]/SpatResol[1]
-    i=0; ypos=yoffset     
-    for slice in slices:
-        imgdata0 = data0[:,:,slice]/np.max(data0)*255
-        imgdata0 = imgdata0.astype(np.uint8)
-        imgdata0  = lut_gray[imgdata0]
-        imgdata0 = np.append (imgdata0, np.zeros([imgdata0.shape[0],imgdata0.shape[1],1], dtype=np.uint8),axis=2)
-        imgdata0[:,:,3]=255 # but don't use it
-        img0 = Image.fromarray(imgdata0)
-        
-        imgdata2 = data2[:,:,slice]/np.max(data2)*255
-        imgdata2 = imgdata2.astype(np.uint8)
-        imgdata2  = lut_right[imgdata2]
-        imgdata2 = np.append (imgdata2, np.zeros([imgdata2.shape[0],imgdata2.shape[1],1], dtype=np.uint8),axis=2)
-        alpha = data2[:,:,slice]/np.max(data2)*255*transparancy
-        alpha = alpha.astype(np.uint8)
-        imgdata2[:,:,3] = alpha 
-        img2 = Image.fromarray(imgdata2)    
-        
-        img0.paste(img2, (0,0), img2)
-        img0 = img0.convert ("RGB") # remove alpha channel
-        if fpdf_version<"2": #old version, write on disk
-          tempfile = '.overlay_sag'+str(slice)+'.png'
-          img0.save(tempfile)
-        else: #new version, write in memory
-          tempfile = BytesIO()
-          img0.save(tempfile, 'png')
-          tempfile.name = 'test.png'
-          tempfile.seek(0)    
+    take = lambda data: np.moveaxis(data[:,:,slices], 2, 0)
+    images = render_slices(take(data0), np.max(data0), [(take(data2), np.max(data2), lut_right)], lut_gray, transparancy)
+    ypos=yoffset     
+    for i, slice in enumerate(slices):
         xpos=(i%slice_per_line)*width + xoffset
         ypos=int(i/slice_per_line)*height + yoffset
-        pdf.image(tempfile, x = xpos, y=ypos, w = width, h=height, type="png")
-        if fpdf_version<"2": os.remove(tempfile) #old version, delete tempfile  
-        i += 1
+        add_image(pdf, images[i], '.overlay_sag'+str(slice)+'.png', xpos, ypos, width, height)
         
     yoffset=ypos+height    
 
     # --------------------------------------- SAGITAL LEFT ----------------------------------------
 
     # find all slices that contain some part of either ROI 
-    slices=[]; npoints=[]
-    thresh = int(0.001*data0.shape[0]*data0.shape[1])
-    for slice in range (0,data0.shape[2]):
-      nz1=np.nonzero(data1[:,:,slice])
-      if len(nz1[0])>thresh: slices.append(slice); npoints.append(len(nz1[0]))
+    slices = list(np.nonzero(nz1>thresh)[0])
 
-      
     # choose a subset of these slices
     if len(slices)>slice_per_line:
       target=slice_per_line # or 1 line
@@ -442,74 +368,78 @@ def HippoDeepReport(SpatResol, data0, data1, data2, data3, text0, text1, text2,
     slices = slices[::-1]
 
     height=width * data0.shape[0]/data0.shape[1] * SpatResol[0]/SpatResol[1]
-    i=0; ypos=yoffset     
-    for slice in slices:
-        imgdata0 = data0[:,:,slice]/np.max(data0)*255
-        imgdata0 = imgdata0.astype(np.uint8)
-        imgdata0  = lut_gray[imgdata0]
-        imgdata0 = np.append (imgdata0, np.zeros([imgdata0.shape[0],imgdata0.shape[1],1], dtype=np.uint8),axis=2)
-        imgdata0[:,:,3]=255 # but don't use it
-        img0 = Image.fromarray(imgdata0)
-        
-        imgdata1 = data1[:,:,slice]/np.max(data1)*255
-        imgdata1 = imgdata1.astype(np.uint8)
-        imgdata1  = lut_left[imgdata1]
-        imgdata1 = np.append (imgdata1, np.zeros([imgdata1.shape[0],imgdata1.shape[1],1], dtype=np.uint8),axis=2)
-        alpha = data1[:,:,slice]/np.max(data1)*255*transparancy
-        alpha = alpha.astype(np.uint8)
-        imgdata1[:,:,3] = alpha 
-        img1 = Image.fromarray(imgdata1)
-       
-        img0.paste(img1, (0,0), img1)
-        img0 = img0.convert ("RGB") # remove alpha channel
-        if fpdf_version<"2": #old version, write on disk
-          tempfile = '.overlay_sag'+str(slice)+'.png'
-          img0.save(tempfile)
-        else: #new version, write in memory
-          tempfile = BytesIO()
-          img0.save(tempfile, 'png')
-          tempfile.name = 'test.png'
-          tempfile.seek(0)    
+    images = render_slices(take(data0), np.max(data0), [(take(data1), np.max(data1), lut_left)], lut_gray, transparancy)
+    ypos=yoffset     
+    for i, slice in enumerate(slices):
         xpos=(i%slice_per_line)*width + xoffset
         ypos=int(i/slice_per_line)*height + yoffset
-        pdf.image(tempfile, x = xpos, y=ypos, w = width, h=height, type="png")
-        if fpdf_version<"2": os.remove(tempfile) #old version, delete tempfile  
-        i += 1
+        add_image(pdf, images[i], '.overlay_sag'+str(slice)+'.png', xpos, ypos, width, height)
         
     pdf.output(filename)
 
 
 
 
-def main():
-
-    # get input filename
-    if len(sys.argv)==2: filename=sys.argv[1]
-    elif len(sys.argv)==1: filename = GetFilename()
-    else: print ("Usage:",sys.argv[0],"[NIFTI_Image]"); sys.exit(2)
+def read_mask(dirname, basename, name, img0):
+    """
+    The output mask name (mask_L, mask_R or brain_mask) of a subject as an
+    uint8 array the size of its T1 image img0, whatever the --mask-format
+    it was written with: full or cropped NIfTI (.nii.gz or .nii), a label
+    map, or a sparse npz. Raises an IOError saying what is missing.
+    """
+    shape = img0.shape[:3]
+    for ext in [".nii.gz", ".nii"]:
+        fname = os.path.join(dirname, basename + "_" + name + ext)
+        if os.path.exists(fname):
+            img = nib.load(fname)
+            data = np.asanyarray(img.dataobj).astype(np.uint8)
+            if data.shape == shape:
+                return data
+            # a mask cropped to the hippocampus box, placed by its affine
+            offset = np.round(np.linalg.inv(img0.affine) @ img.affine[:,3])[:3].astype(int)
+            full = np.zeros(shape, np.uint8)
+            full[tuple(slice(o, o + n) for o, n in zip(offset, data.shape))] = data
+            return full
+        fname = os.path.join(dirname, basename + "_labels" + ext)
+        if os.path.exists(fname):
+            labels = np.asanyarray(nib.load(fname).dataobj)
+            if name == "brain_mask":
+                return (labels > 0).astype(np.uint8)
+            return (labels == (1 if name == "mask_L" else 2)).astype(np.uint8) * 255
+    fname = os.path.join(dirname, basename + "_masks_LR.npz")
+    if name != "brain_mask" and os.path.exists(fname):
+        sparse = np.load(fname)
+        if name[-1] + "_ijk" not in sparse.files: # only the other side was written
+            raise IOError("no %s_%s output" % (basename, name))
+        full = np.zeros(shape, np.uint8)
+        full[tuple(sparse[name[-1] + "_ijk"].T)] = sparse[name[-1] + "_value"]
+        return full
+    raise IOError("no %s_%s output" % (basename, name))
+
+def report_from_outputs(filename):
+    """
+    Generate the PDF report of a T1 image already processed by HippoDeep,
+    from its outputs next to it (masks and _hippoLR_volumes.csv).
+    Returns the PDF filename; raises an exception saying why it couldn't.
+    """
+    dirname  = os.path.dirname(filename)
+    basename = subject_base(os.path.basename(filename))
 
     #read data
     try: img0 = nib.load(filename)
-    except: basename = os.path.basename(filename); print ("Error reading "+basename); sys.exit(2)
+    except Exception as e: raise IOError("can't read %s (%s)" % (os.path.basename(filename), e))
     data0 = np.asanyarray(img0.dataobj).astype(np.float32)
-    dirname  = os.path.dirname(filename)
-    basename = os.path.splitext(os.path.splitext(os.path.basename(filename))[0])[0]
-    SpatResol = np.asarray(img0.header.get_zooms())
-    
-    try: img1 = nib.load(os.path.join(dirname,basename+"_mask_L.nii.gz"))
-    except: print ("Error reading "+basename+"_mask_L.nii.gz"); sys.exit(2)
-    data1 = np.asanyarray(img1.dataobj).astype(np.float32)
-    data1 /= np.max(data1) # normalize to 1.0
-
-    try: img2 = nib.load(os.path.join(dirname,basename+"_mask_R.nii.gz"))
-    except: print ("Error reading "+basename+"_mask_R.nii.gz"); sys.exit(2)
-    data2 = np.asanyarray(img2.dataobj).astype(np.float32)
-    data2 /= np.max(data2) # normalize to 1.0
-
-    try: img3 = nib.load(os.path.join(dirname,basename+"_brain_mask.nii.gz"))
-    except: print ("Error reading "+basename+"_brain_mask.nii.gz"); sys.exit(2)
-    data3 = np.asanyarray(img3.dataobj).astype(np.float32)
-    #data3 /= np.max(data3) # normalize to 1.0    
+    if data0.ndim == 4: data0 = data0.mean(3) # a time serie, averaged as HippoDeep does
+    SpatResol = np.asarray(img0.header.get_zooms()[:3])
+
+    data1 = read_mask(dirname, basename, "mask_L", img0)
+    data2 = read_mask(dirname, basename, "mask_R", img0)
+    if not data1.any() or not data2.any():
+        raise ValueError("empty hippocampus mask")
+    # the masks are kept as uint8 (scaled by their maximum by HippoDeepReport), as given by the pipeline
+    data3 = read_mask(dirname, basename, "brain_mask", img0)
+    # the intra-cranial volume of the native brain mask, as in the report of the pipeline
+    vol = np.count_nonzero(data3) * np.abs(np.linalg.det(img0.affine))
 
     o1 = nib.orientations.io_orientation(img0.affine)
     o2 = np.array([[ 0., -1.], [ 1.,  1.], [ 2.,  1.]]) # We work in LAS space (same as the mni_icbm152 template)
@@ -520,18 +450,12 @@ def main():
     data3 = nib.apply_orientation(data3, trn )
     SpatResol[int(trn[0,0])],  SpatResol[int(trn[1,0])], SpatResol[int(trn[2,0])] = SpatResol[0],  SpatResol[1], SpatResol[2]
 
-    
+    csvname = basename+"_hippoLR_volumes.csv"
     try: 
-      with open(os.path.join(dirname,basename+"_hippoLR_volumes.csv")) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        line_count = 0
-        for row in csv_reader:
-          line_count += 1
-          if line_count == 2:
-            vol      = float(row[0])
-            volsAA_L = float(row[1])
-            volsAA_R = float(row[2])
-    except: print ("Error reading "+basename+"_hippoLR_volumes.csv"); sys.exit(2)
+      with open(os.path.join(dirname,csvname)) as csv_file:
+        rows = list(csv.reader(csv_file, delimiter=','))
+      volsAA_L, volsAA_R = [float(x) for x in rows[1][1:3]] # eTIV,hippoL,hippoR
+    except (OSError, ValueError, IndexError) as e: raise IOError("can't read %s (%s)" % (csvname, e))
     
     text0 = "HippoDeep Report"
     text1="Total Intracranial Volume:  "
@@ -542,10 +466,23 @@ def main():
     text3 += "{:.2f}".format(float(volsAA_R)/1000,2)+" ml" # transform mm^3 to mililiter
     filename = os.path.join(dirname,basename+".pdf")
     HippoDeepReport (SpatResol,data0, data1, data2, data3, text0, text1, text2, text3, filename)
+    return filename
+
+
+def main():
+
+    # get input filename
+    if len(sys.argv)==2: filename=sys.argv[1]
+    elif len(sys.argv)==1:
+        from GetFilename import GetFilename # tkinter, only when asking for a file
+        filename = GetFilename()
+    else: print ("Usage:",sys.argv[0],"[NIFTI_Image]   (see hippodeep_reports.py for several images)"); sys.exit(2)
+
+    try: report_from_outputs(filename)
+    except Exception as e: print ("Error: %s" % e); sys.exit(2)
 
     #end
     if sys.platform=="win32": os.system("pause") # windows
         
 if __name__ == '__main__':
     main()        
-        
@@ -0,0 +1,182 @@
+#
+# HippoDeep benchmarks
+#
+# Runs model_apply_head_and_hippo.py (with --profile, in a fresh process per
+# case and thread count) on synthetic volumes (see synthetic.py), and reports
+# for each run the median time of every stage (including the PDF report of
+# HippoDeepReport), the throughput and the peak memory.
+# Results are saved as JSON, and can be compared against a stored baseline:
+#
+#   python benchmarks/run_benchmarks.py --threads 1,4,8 --save-baseline
+#   ... (later, after some change)
+#   python benchmarks/run_benchmarks.py --threads 1,4,8 --compare
+#
+# --compare exits with status 1 if a stage or the throughput of a run got
+# slower than the baseline by more than --tolerance.
+# The start-up time, i.e. the import of the pipeline module in a fresh
+# interpreter (python -X importtime), is measured and compared as well, with
+# the modules it spends the most time importing.
+#
+
+import os, sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+scriptpath = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, scriptpath)
+from synthetic import CASES, make_case
+
+pipeline_script = os.path.join(scriptpath, "..", "model_apply_head_and_hippo.py")
+default_baseline = os.path.join(scriptpath, "baseline.json")
+
+
+def run_case(fnames, threads, workdir):
+    " run the pipeline on fnames in a new process; returns the per-subject profiles, the process wall time and peak memory "
+    profile = os.path.join(workdir, "profile.jsonl")
+    if os.path.exists(profile):
+        os.remove(profile)
+    cmd = [sys.executable, "-W", "ignore", pipeline_script, "--no-cache", "--threads-per-worker", str(threads), "--profile", profile] + fnames
+    t0 = time.perf_counter()
+    with open(os.path.join(workdir, "log.txt"), "w") as log:
+        p = subprocess.Popen(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, "wait4"):
+            _, status, rusage = os.wait4(p.pid, 0)
+            p.returncode = os.waitstatus_to_exitcode(status)
+            peak_mb = rusage.ru_maxrss / (1024. if sys.platform != "darwin" else 1024.*1024)
+        else:
+            p.wait()
+            peak_mb = None
+    wall = time.perf_counter() - t0
+    if p.returncode != 0:
+        raise RuntimeError("pipeline failed (%d), see %s" % (p.returncode, os.path.join(workdir, "log.txt")))
+    profiles = [json.loads(line) for line in open(profile)]
+    if peak_mb is None:
+        peak_mb = max(prof["rss_max_mb"] for prof in profiles)
+    return profiles, wall, peak_mb
+
+def measure_startup(repeat=3):
+    " median import time of the pipeline module in a new interpreter, and of the top-level modules it imports (> 10ms) "
+    cmd = [sys.executable, "-X", "importtime", "-c", "import model_apply_head_and_hippo"]
+    totals, modules = [], {}
+    for r in range(repeat):
+        p = subprocess.run(cmd, cwd=os.path.dirname(pipeline_script), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        # "import time: self [us] | cumulative | imported package", indented by depth
+        for line in p.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            self_us, cumulative, name = line[len("import time:"):].split("|")
+            if name.strip() == "model_apply_head_and_hippo":
+                totals.append(int(cumulative) / 1e6)
+            elif name.startswith("   ") and not name.startswith("    ") and int(cumulative) > 10000:
+                modules.setdefault(name.strip(), []).append(int(cumulative) / 1e6)
+    return dict(import_s=round(float(np.median(totals)), 3),
+                modules=dict((k, round(float(np.median(v)), 3)) for k, v in sorted(modules.items(), key=lambda kv: -max(kv[1]))))
+
+def summarize(profiles, wall, peak_mb):
+    " median of each stage over the subjects (the first one, warming up, is left out when there are more) "
+    warm = profiles[1:] or profiles
+    stages = {}
+    for name in profiles[0]["stages"]:
+        stages[name] = dict((m, round(float(np.median([p["stages"][name][m] for p in warm])), 4)) for m in ["wall", "cpu"])
+    subject_wall = float(np.median([p["wall"] for p in warm]))
+    return dict(stages=stages, subject_wall=round(subject_wall, 4),
+                subjects_per_min=round(60. / subject_wall, 3),
+                process_wall=round(wall, 3), process_subjects_per_min=round(60. * len(profiles) / wall, 3),
+                peak_memory_mb=round(peak_mb, 1))
+
+def compare(results, baseline, tolerance):
+    " print the relative change of each run against the baseline, returns the regressions "
+    regressions = []
+    if "startup" in results and "startup" in baseline:
+        old, new = baseline["startup"]["import_s"], results["startup"]["import_s"]
+        slower = new > old * (1 + tolerance) and new - old > .05
+        print("%-20s %8.3fs -> %8.3fs  %+6.1f%%%s" % ("startup (import)", old, new, 100 * (new - old) / old, "  SLOWER" if slower else ""))
+        if slower:
+            regressions.append(("startup", "import"))
+    for key, run in sorted(results["runs"].items()):
+        ref = baseline["runs"].get(key)
+        if ref is None:
+            print("%-24s (not in baseline)" % key)
+            continue
+        print(key)
+        rows = [(name, ref["stages"][name]["wall"], st["wall"]) for name, st in run["stages"].items() if name in ref["stages"]]
+        rows.append(("subject", ref["subject_wall"], run["subject_wall"]))
+        for name, old, new in rows:
+            change = (new - old) / old if old > 0 else 0.
+            # ignore the jitter of the very short stages
+            slower = change > tolerance and new - old > .01
+            print("  %-18s %8.3fs -> %8.3fs  %+6.1f%%%s" % (name, old, new, 100 * change, "  SLOWER" if slower else ""))
+            if slower:
+                regressions.append((key, name))
+        print("  %-18s %8.1fMB -> %7.1fMB" % ("peak memory", ref["peak_memory_mb"], run["peak_memory_mb"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark HippoDeep on synthetic volumes")
+    parser.add_argument("--cases", default=",".join(CASES), help="comma separated cases among: " + ", ".join(CASES))
+    parser.add_argument("--threads", default="1,%d" % (os.cpu_count() or 1), help="comma separated torch thread counts (default: 1 and all CPUs)")
+    parser.add_argument("--subjects", type=int, default=3, help="subjects per run (the first one is a warm-up, unless there is a single one)")
+    parser.add_argument("--datadir", help="where to keep the synthetic volumes (default: a temporary directory)")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<date>.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="also store the results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare the results with the baseline")
+    parser.add_argument("--baseline", default=default_baseline, help="baseline file (default: benchmarks/baseline.json)")
+    parser.add_argument("--tolerance", type=float, default=.1, help="relative slow-down reported as a regression (default: 0.1)")
+    args = parser.parse_args()
+
+    import torch
+    results = dict(date=time.strftime("%Y-%m-%d %H:%M:%S"), machine=platform.machine(), processor=platform.processor(),
+                   cpu_count=os.cpu_count(), python=platform.python_version(), torch=torch.__version__,
+                   subjects=args.subjects, runs={})
+    results["startup"] = measure_startup()
+    print("Start-up (import) %.2fs: %s" % (results["startup"]["import_s"], ", ".join("%s %.2fs" % kv for kv in results["startup"]["modules"].items())))
+    datadir = args.datadir or tempfile.mkdtemp(prefix="hippodeep_bench_")
+    os.makedirs(datadir, exist_ok=True)
+    try:
+        for case in args.cases.split(","):
+            print("Generating %s volumes" % case)
+            fnames = make_case(case, datadir, args.subjects)
+            for threads in sorted(set(int(t) for t in args.threads.split(","))):
+                workdir = tempfile.mkdtemp(prefix="run_", dir=datadir)
+                # outputs are written next to the inputs, so run on links from a fresh directory
+                links = []
+                for fname in fnames:
+                    links.append(os.path.join(workdir, os.path.basename(fname)))
+                    os.symlink(os.path.abspath(fname), links[-1])
+                print("Running %s with %d thread(s)" % (case, threads))
+                run = summarize(*run_case(links, threads, workdir))
+                results["runs"]["%s/t%d" % (case, threads)] = run
+                print("  %.2fs per subject, %.2f subjects/min, peak memory %.0f MB" % (run["subject_wall"], run["subjects_per_min"], run["peak_memory_mb"]))
+                shutil.rmtree(workdir)
+    finally:
+        if not args.datadir:
+            shutil.rmtree(datadir)
+
+    output = args.output or os.path.join(scriptpath, "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    json.dump(results, open(output, "w"), indent=1)
+    print("Results saved as " + output)
+    if args.save_baseline:
+        json.dump(results, open(args.baseline, "w"), indent=1)
+        print("Baseline saved as " + args.baseline)
+
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print("No baseline " + args.baseline)
+            sys.exit(1)
+        regressions = compare(results, json.load(open(args.baseline)), args.tolerance)
+        if regressions:
+            print("%d regression(s): %s" % (len(regressions), ", ".join("%s %s" % r for r in regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
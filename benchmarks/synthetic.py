@@ -0,0 +1,79 @@
+#
+# Synthetic T1-like volumes for the benchmarks
+#
+# The bundled example_brain_t1.nii.gz is resampled (trilinear) onto the grid
+# of a typical acquisition, centered on the same head, then given a smooth
+# bias field and some noise, and stored as int16 as scanners do.
+#
+# Usage:
+#   python benchmarks/synthetic.py OUTDIR [CASE ...]
+#
+
+import os, sys
+import numpy as np
+import nibabel
+import scipy.ndimage
+
+scriptpath = os.path.dirname(os.path.realpath(__file__))
+template = os.path.join(scriptpath, "..", "example_brain_t1.nii.gz")
+
+# name: (shape, voxel size in mm, number of frames)
+CASES = {
+    "1mm_256":      ((256, 256, 256), (1., 1., 1.), 1),
+    "0.8mm_320":    ((320, 320, 320), (.8, .8, .8), 1),
+    "aniso_0.5x1.2": ((480, 480, 150), (.5, .5, 1.2), 1),
+    "4d_2mm_x8":    ((120, 120, 90), (2., 2., 2.), 8), # a time serie, averaged by the pipeline
+}
+
+
+def make_volume(shape, zooms, frames=1, seed=0):
+    " a Nifti1Image of the template head on a (shape, zooms) grid, with frames noisy copies if > 1 "
+    rng = np.random.RandomState(seed)
+    src = nibabel.load(template)
+    srcdata = np.asarray(src.dataobj, dtype=np.float32)
+
+    # LAS grid of the requested size, centered on the center of the template
+    center = src.affine[:3,:3] @ ((np.array(src.shape[:3]) - 1) / 2.) + src.affine[:3,3]
+    affine = np.diag([-zooms[0], zooms[1], zooms[2], 1.])
+    affine[:3,3] = center - affine[:3,:3] @ ((np.array(shape) - 1) / 2.)
+
+    # voxel of the new grid -> voxel of the template
+    vox2src = np.linalg.inv(src.affine) @ affine
+    data = scipy.ndimage.affine_transform(srcdata, vox2src[:3,:3], vox2src[:3,3], output_shape=shape, order=1)
+
+    # smooth multiplicative bias field
+    xyz = np.ogrid[tuple(slice(-1, 1, n * 1j) for n in shape)]
+    data *= 1 + .15 * (xyz[0] * .8 - xyz[1] * .5 + xyz[2] * .3)
+
+    scale = 1000. / max(srcdata.max(), 1)
+    out = []
+    for t in range(frames):
+        noisy = data * scale + rng.normal(0, 15, shape).astype(np.float32)
+        out.append(np.clip(noisy, 0, 32767).astype(np.int16))
+    out = out[0] if frames == 1 else np.stack(out, -1)
+
+    img = nibabel.Nifti1Image(out, affine)
+    img.header.set_xyzt_units("mm", "sec")
+    img.set_qform(affine, 1)
+    img.set_sform(affine, 1)
+    return img
+
+def make_case(name, outdir, copies=1):
+    " write (or reuse) copies of the volume of a case in outdir, returns their filenames "
+    shape, zooms, frames = CASES[name]
+    fnames = []
+    for i in range(copies):
+        fname = os.path.join(outdir, "%s_%02d.nii.gz" % (name, i))
+        if not os.path.exists(fname):
+            make_volume(shape, zooms, frames, seed=i).to_filename(fname)
+        fnames.append(fname)
+    return fnames
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: synthetic.py OUTDIR [CASE ...]   cases: " + " ".join(CASES))
+        sys.exit(1)
+    os.makedirs(sys.argv[1], exist_ok=True)
+    for name in sys.argv[2:] or CASES:
+        print(" ".join(make_case(name, sys.argv[1])))
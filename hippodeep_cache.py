@@ -0,0 +1,147 @@
+#
+# On-disk cache of HippoDeep results
+#
+# Entries are keyed by a hash of the input voxel data and affine, of the
+# network weights and of the pipeline settings, so re-running a cohort
+# (e.g. for a new report template or a re-aggregation) skips the inference
+# of every image that didn't change, and only re-emits its outputs.
+# Each entry holds eTIV, the hippocampal volumes, the native-to-MNI matrix M
+# and the compressed masks (the hippocampus ones within their box, none for
+# volumes-only results). The least recently used entries are evicted
+# when the cache grows over its size cap.
+#
+# --check processes the example brain twice through a temporary cache, with
+# the default outputs and volumes-only, and fails unless the second run of
+# each is a cache hit with the same volumes.
+#
+# Usage:
+#   python hippodeep_cache.py --check
+#
+
+import os, sys
+import shutil
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+
+CACHE_VERSION = "2" # bump when the content of an entry changes
+
+def default_cache_dir():
+    return os.environ.get("HIPPODEEP_CACHE") or os.path.join(os.path.expanduser("~"), ".cache", "hippodeep")
+
+def files_digest(fnames):
+    " hash of the content of some files, e.g. the network weights "
+    h = hashlib.blake2b(digest_size=20)
+    for fname in fnames:
+        with open(fname, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, directory=None, max_bytes=2 << 30, salt=""):
+        " salt identifies everything besides the image that the results depend on (weights, settings) "
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.salt = CACHE_VERSION + salt
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, data, affine):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(self.salt.encode("utf-8"))
+        h.update(("%s %s" % (data.shape, data.dtype.str)).encode("utf-8"))
+        h.update(np.ascontiguousarray(affine, dtype=np.float64))
+        h.update(np.ascontiguousarray(data))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        " the cached entry as a dict, or None "
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                entry = dict((k, f[k]) for k in f.files)
+        except (OSError, ValueError, KeyError):
+            return None
+        try: os.utime(path) # mark as recently used
+        except OSError: pass
+        for k in ["eTIV", "eTIV_native", "hippoL", "hippoR"]:
+            entry[k] = float(entry[k])
+        if np.isnan(entry["eTIV_native"]):
+            entry["eTIV_native"] = None
+        if entry["brain_mask"].ndim == 0:
+            entry["brain_mask"] = None
+        if entry["mask_L"].size == 0: # volumes-only
+            entry["mask_L"] = entry["mask_R"] = entry["mask_offset"] = None
+        return entry
+
+    def put(self, key, res):
+        " store a HippoDeepPipeline.process() result "
+        entry = dict(eTIV=res["eTIV"], hippoL=res["hippoL"], hippoR=res["hippoR"], M=res["M"],
+                     eTIV_native=np.nan if res["eTIV_native"] is None else res["eTIV_native"],
+                     brain_mask=np.array(0, np.uint8) if res["brain_mask"] is None else res["brain_mask"],
+                     mask_L=res["mask_L"], mask_R=res["mask_R"], mask_offset=res["mask_offset"])
+        if res["mask_L"] is None: # volumes-only, and None can't be stored without pickling
+            entry.update(mask_L=np.zeros((0, 0, 0), np.uint8), mask_R=np.zeros((0, 0, 0), np.uint8), mask_offset=np.zeros(0, int))
+        # write then rename, so that concurrent workers never see a partial entry
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, **entry)
+            os.replace(tmpname, self._path(key))
+        except:
+            if os.path.exists(tmpname): os.remove(tmpname)
+            raise
+        self.evict()
+
+    def evict(self):
+        " remove the least recently used entries until the cache fits in max_bytes "
+        entries = []
+        for e in os.scandir(self.directory):
+            if e.name.endswith(".npz"):
+                try: st = e.stat()
+                except OSError: continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try: os.remove(path)
+            except OSError: pass
+            total -= size
+
+
+def check():
+    " process the example brain twice per outputs setting through a temporary cache, returns the settings whose second run isn't a cache hit "
+    from model_apply_head_and_hippo import HippoDeepPipeline, cache_from_args
+    example_t1 = os.path.join(os.path.dirname(os.path.realpath(__file__)), "example_brain_t1.nii.gz")
+    failed = []
+    directory = tempfile.mkdtemp(prefix="hippodeep_cache_check")
+    try:
+        for name, outputs in [("default", None), ("volumes-only", ["volumes"])]:
+            args = argparse.Namespace(no_cache=False, cache_dir=directory, cache_size=2048, refresh=False)
+            if outputs is not None:
+                args.outputs = outputs
+            pipeline = HippoDeepPipeline(verbose=False, cache=cache_from_args(args), outputs=outputs)
+            first, second = pipeline.process(example_t1), pipeline.process(example_t1)
+            hit = second.get("cached", False) and all(first[k] == second[k] for k in ["eTIV", "hippoL", "hippoR"])
+            print("%-14s %s" % (name, "cache hit" if hit else "NO CACHE HIT"))
+            if not hit:
+                failed.append(name)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="On-disk cache of HippoDeep results")
+    parser.add_argument("--check", action="store_true", help="check that processing the example brain twice hits the cache, with the default outputs and volumes-only")
+    args = parser.parse_args()
+    if not args.check:
+        parser.error("nothing to do, use --check")
+    if check():
+        sys.exit(1)
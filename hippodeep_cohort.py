@@ -0,0 +1,222 @@
+#
+# Sharded HippoDeep runs over large cohorts
+#
+# "run" segments the T1 images listed in a manifest (a text file of one path
+# per line, or a .csv whose "path" or "filename" column, else the first one,
+# holds them; relative paths are relative to the manifest), or only the
+# shard i of N of them with --shard i/N (1 <= i <= N: the images i, i+N,
+# i+2N... of the manifest), e.g. one shard per task of an array job.
+# The outputs are written next to each image as by model_apply_head_and_hippo.py,
+# and the result of each subject (volumes, time and warnings, or its error)
+# is appended to RESULTS/shard-i-of-N.jsonl as soon as it is done, as a
+# single write of one JSON line: an interruption loses at most the subjects
+# being processed, and running the shard again skips the ones already done.
+#
+# "merge" gathers the shard files of RESULTS into one table in the manifest
+# order, as CSV, or Parquet (with pandas and pyarrow) for a .parquet output.
+#
+# Usage:
+#   python hippodeep_cohort.py run cohort.txt --results results/ --shard $SLURM_ARRAY_TASK_ID/100 [--volumes-only ...]
+#   python hippodeep_cohort.py merge results/ -o cohort_volumes.csv|cohort_volumes.parquet [--manifest cohort.txt]
+#
+
+import os, sys
+import csv
+import glob
+import json
+import time
+import argparse
+
+COLUMNS = ["filename", "eTIV", "hippoL", "hippoR", "time", "status", "warnings", "error"]
+
+
+def read_manifest(fname):
+    " the T1 images listed in a manifest, as paths relative to the current directory or absolute "
+    base = os.path.dirname(fname)
+    with open(fname, newline="") as f:
+        if fname.lower().endswith(".csv"):
+            rows = [r for r in csv.reader(f) if r]
+            header = [c.strip().lower() for c in rows[0]] if rows else []
+            col = next((header.index(c) for c in ["path", "filename"] if c in header), 0)
+            paths = [r[col].strip() for r in rows[1:]]
+        else:
+            paths = [l.strip() for l in f if l.strip() and not l.lstrip().startswith("#")]
+    return [os.path.join(base, p) for p in paths]
+
+def parse_shard(text):
+    " (i, N) of 'i/N' "
+    try:
+        i, n = [int(x) for x in text.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, e.g. 3/10")
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError("shard %d/%d: i must be within 1..N" % (i, n))
+    return i, n
+
+def shard_filename(results, shard):
+    return os.path.join(results, "shard-%d-of-%d.jsonl" % shard)
+
+def append_record(fname, record):
+    " append record to fname as one JSON line, with a single write to the file opened in append mode, synced to disk "
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def read_records(fname, repair=False):
+    """
+    The records of a results file. A last line cut by an interruption is
+    ignored, and with repair also removed, so that appending can go on.
+    """
+    with open(fname, "rb") as f:
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    if repair and end < len(data):
+        with open(fname, "r+b") as f:
+            f.truncate(end)
+    records = []
+    for line in data[:end].splitlines():
+        try:
+            records.append(json.loads(line.decode("utf-8")))
+        except ValueError:
+            pass
+    return records
+
+
+def run_shard(args):
+    from model_apply_head_and_hippo import HippoDeepPipeline, run_batch, chunks, pipeline_settings
+    import torch
+    settings = pipeline_settings(args)
+    fnames = read_manifest(args.manifest)
+    i, n = args.shard
+    shard = [(k, f) for k, f in enumerate(fnames) if k % n == i - 1]
+
+    os.makedirs(args.results, exist_ok=True)
+    resultsname = shard_filename(args.results, args.shard)
+    done = set()
+    if os.path.exists(resultsname):
+        done = set(r["index"] for r in read_records(resultsname, repair=True) if r.get("status") == "ok")
+    todo = [(k, f) for k, f in shard if k not in done]
+    print("Shard %d/%d: %d of the %d images of %s, %d already done" % (i, n, len(shard), len(fnames), args.manifest, len(shard) - len(todo)))
+    if not todo:
+        return 0
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    pipeline = HippoDeepPipeline(**settings)
+    report = "report" in args.outputs
+    failed = 0
+    for chunk in chunks(todo, max(1, args.batch_size)):
+        t0 = time.time()
+        try:
+            results = run_batch(pipeline, [f for k, f in chunk], report)
+            errors = [None] * len(chunk)
+        except Exception as e:
+            if len(chunk) > 1: # find the failing subject(s)
+                results, errors = [], []
+                for k, f in chunk:
+                    try:
+                        results.append(run_batch(pipeline, [f], report)[0])
+                        errors.append(None)
+                    except Exception as e:
+                        results.append(None)
+                        errors.append("%s: %s" % (type(e).__name__, e))
+            else:
+                results, errors = [None], ["%s: %s" % (type(e).__name__, e)]
+        t = (time.time() - t0) / len(chunk)
+        for (k, f), res, error in zip(chunk, results, errors):
+            record = dict(index=k, filename=f, time=round(t, 3), shard="%d/%d" % args.shard)
+            if res is None:
+                record.update(status="error", error=error or "can't open the file")
+                failed += 1
+            else:
+                record.update(status="ok", eTIV=float(res["eTIV"]), hippoL=float(res["hippoL"]), hippoR=float(res["hippoR"]),
+                              warnings="; ".join(w.strip() for w in res["warnings"]))
+            append_record(resultsname, record)
+
+    print("Shard %d/%d done: %d image(s) processed, %d failure(s), results in %s" % (i, n, len(todo), failed, resultsname))
+    return 1 if failed else 0
+
+
+def merge(results, manifest=None):
+    """
+    The records of the shard files of results, one per image in the manifest
+    order: the successful one if there are some, else the last one.
+    With a manifest, also returns the images that have no record.
+    """
+    records = {}
+    for fname in sorted(glob.glob(os.path.join(glob.escape(results), "shard-*-of-*.jsonl"))):
+        for r in read_records(fname):
+            if r.get("status") == "ok" or records.get(r["index"], {}).get("status") != "ok":
+                records[r["index"]] = r
+    rows = [records[k] for k in sorted(records)]
+    missing = []
+    if manifest:
+        missing = [f for k, f in enumerate(read_manifest(manifest)) if k not in records]
+    return rows, missing
+
+def write_table(rows, fname):
+    " write the rows as a CSV, or a Parquet for a .parquet fname, through a temporary file "
+    tmpname = fname + ".tmp"
+    table = [dict((c, r.get(c)) for c in COLUMNS) for r in rows]
+    if fname.lower().endswith(".parquet"):
+        try:
+            import pandas
+            pandas.DataFrame(table, columns=COLUMNS).to_parquet(tmpname, index=False)
+        except ImportError:
+            raise RuntimeError("Parquet output needs pandas and pyarrow (pip install pandas pyarrow)")
+    else:
+        with open(tmpname, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            for r in table:
+                writer.writerow(["%4f" % r[c] if isinstance(r[c], float) and c != "time" else ("" if r[c] is None else r[c]) for c in COLUMNS])
+    os.replace(tmpname, fname)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sharded HippoDeep runs over the images of a manifest, and the merge of their results")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    run = commands.add_parser("run", help="segment the images of a manifest (or of one of its shards)")
+    run.add_argument("manifest", help="text file of one T1 image per line, or .csv with a path (or filename) column")
+    run.add_argument("--results", required=True, metavar="DIR", help="directory of the shard results files")
+    run.add_argument("--shard", type=parse_shard, default=(1, 1), metavar="i/N", help="process the images i, i+N, i+2N... of the manifest (1 <= i <= N, default: 1/1, all of them)")
+    run.add_argument("--threads", type=int, default=0, help="torch CPU threads (default: all CPU threads)")
+    run.add_argument("--batch-size", type=int, default=1, metavar="K", help="segment K subjects at once, as a single batch through each network")
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["run"]: # merge doesn't import the pipeline (and torch)
+        from model_apply_head_and_hippo import add_pipeline_arguments
+        add_pipeline_arguments(run)
+    mrg = commands.add_parser("merge", help="gather the results of the shards into one table")
+    mrg.add_argument("results", metavar="DIR", help="directory of the shard results files")
+    mrg.add_argument("-o", "--output", required=True, help="merged table, .csv or .parquet")
+    mrg.add_argument("--manifest", help="list the images of the manifest that have no results")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        sys.exit(run_shard(args))
+
+    rows, missing = merge(args.results, args.manifest)
+    try:
+        write_table(rows, args.output)
+    except RuntimeError as e:
+        print("Error: %s" % e)
+        sys.exit(2)
+    failed = [r for r in rows if r.get("status") != "ok"]
+    print("Merged %d image(s) into %s, %d failure(s)" % (len(rows), args.output, len(failed)))
+    for r in failed:
+        print("  %s: %s" % (r["filename"], r.get("error")))
+    if missing:
+        print("%d image(s) of %s without results:" % (len(missing), args.manifest))
+        for f in missing:
+            print("  " + f)
+    if failed or missing:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
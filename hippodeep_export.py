@@ -0,0 +1,82 @@
+#
+# Export of frozen HippoDeep networks
+#
+# Traces the head, MNI-affine and hippocampus networks with their weights,
+# folds the BatchNorm layers of HeadModel (bn0a ... bn0u) into the
+# convolutions before them, and freezes the graphs (weights as constants,
+# no Python in the loop). The artefacts are saved in torchparams/, where
+# the pipeline loads them instead of the eager modules when they match the
+# current weights.
+# HippoModel's bn1 and bn2 follow a max-pooling, not a convolution, and
+# feed zero-padded convolutions: they can't be folded exactly and are kept.
+#
+# Usage:
+#   python hippodeep_export.py          # writes torchparams/frozen_*.pt
+#
+
+import os, sys
+import json
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from hippodeep_cache import files_digest
+
+FROZEN_NAMES = ["head", "affine", "hippo"]
+
+# (convolution, following BatchNorm) of HeadModel
+HEAD_CONV_BN = [("conv0b", "bn0a"), ("conv1b", "bn1a"), ("conv2b", "bn2a"), ("conv3b", "bn3a"),
+                ("conv2v", "bn2u"), ("conv1v", "bn1u"), ("conv0v", "bn0u")]
+
+
+try: scriptpath = sys._MEIPASS # when running frozen with pyInstaller
+except: scriptpath = os.path.dirname(os.path.realpath(__file__))
+
+frozen_dir = os.path.join(scriptpath, "torchparams")
+
+def frozen_filename(name):
+    return os.path.join(frozen_dir, "frozen_%s.pt" % name)
+
+def frozen_info(params):
+    " the description of the frozen artefacts, if they exist and were exported from the weights files params, else None "
+    try:
+        info = json.load(open(os.path.join(frozen_dir, "frozen.json")))
+    except (OSError, ValueError):
+        return None
+    if info.get("weights") != files_digest(params) or not all(os.path.exists(frozen_filename(n)) for n in FROZEN_NAMES):
+        return None
+    return info
+
+def load_frozen(params, device):
+    " the frozen (head, affine, hippo) networks exported from the weights files params, or None if there are none "
+    if frozen_info(params) is None:
+        return None
+    try:
+        return [torch.jit.load(frozen_filename(n), map_location=device) for n in FROZEN_NAMES]
+    except Exception as e: # e.g. exported by an incompatible torch version
+        print(" *** Warning: can't load the frozen networks (%s), using the eager ones" % e)
+        return None
+
+def fold_batchnorms(model, pairs):
+    " fold each BatchNorm into the convolution before it (in eval mode) "
+    for conv, bn in pairs:
+        setattr(model, conv, fuse_conv_bn_eval(getattr(model, conv), getattr(model, bn)))
+        setattr(model, bn, nn.Identity())
+    return model
+
+def export():
+    from model_apply_head_and_hippo import HippoDeepPipeline, params_head, params_affine, params_hippo
+    pipeline = HippoDeepPipeline(verbose=False, frozen=False)
+    nets = [fold_batchnorms(pipeline.net, HEAD_CONV_BN), pipeline.netAff, pipeline.hipponet]
+    examples = [torch.zeros(1, 1, 64, 64, 64), torch.zeros(1, 2, 64, 64, 64), torch.zeros(2, 1, 48, 72, 64)]
+    with torch.no_grad():
+        for name, net, example in zip(FROZEN_NAMES, nets, examples):
+            frozen = torch.jit.freeze(torch.jit.trace(net.eval(), example))
+            torch.jit.save(frozen, frozen_filename(name))
+            print("Saved " + frozen_filename(name))
+    info = dict(weights=files_digest([params_head, params_affine, params_hippo]), torch=torch.__version__)
+    json.dump(info, open(os.path.join(frozen_dir, "frozen.json"), "w"))
+
+
+if __name__ == "__main__":
+    export()
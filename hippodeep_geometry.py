@@ -0,0 +1,59 @@
+#
+# Geometry cache of HippoDeep
+#
+# The sampling grids that only depend on the shape and orientation of the
+# input image (the 64^3 grid of the head networks, the native-space grids
+# of the brain mask resampling) are kept between subjects: cohorts from one
+# scanner share them, so building them becomes a lookup.
+# The native-space grids hold one (x,y,z) float32 per voxel, e.g. 200 MB
+# for a 256^3 image, which adds to the peak memory, so they are only kept
+# with --geometry-cache MB (an LRU bounded by the total size of its arrays);
+# the grids that don't fit are built slab by slab as before. The 64^3 grids
+# (3 MB each) are always kept.
+#
+
+import collections
+
+
+def nbytes(value):
+    " total size of the arrays (or tensors) of value, or of a list/tuple of them "
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v) for v in value)
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if hasattr(value, "element_size"): # torch tensors
+        return value.element_size() * value.nelement()
+    return 0
+
+
+class GeometryCache(object):
+    " an LRU cache of arrays/tensors, bounded by max_bytes "
+    def __init__(self, max_bytes=256 << 20):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+
+    def fits(self, size):
+        return 0 < size <= self.max_bytes
+
+    def get(self, key, build):
+        " the value of key, built (and kept, if it fits) by build() when not cached "
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = build()
+        size = nbytes(value)
+        if self.fits(size):
+            while self.size + size > self.max_bytes:
+                self.size -= nbytes(self.entries.popitem(last=False)[1])
+            self.entries[key] = value
+            self.size += size
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
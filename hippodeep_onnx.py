@@ -0,0 +1,150 @@
+#
+# ONNX export of the HippoDeep networks, and their ONNX Runtime backend
+#
+# --export writes the head, MNI-affine and hippocampus networks as
+# torchparams/hippodeep_{head,affine,hippo}.onnx (opset 20, whose GridSample
+# handles the 5D warp of ModelAff), with an onnx.json recording the weights
+# they come from. With --backend onnx, the pipeline runs them with ONNX
+# Runtime on the CPU instead of torch; the rest of the pipeline (resampling,
+# back-projection) still uses torch, which is still imported at start-up:
+# the ONNX backend changes the network kernels, not the start-up time.
+# The hippocampus network takes any batch size (--batch-size), the other two
+# a single subject, as the pipeline runs them.
+#
+# --benchmark times each network with torch and with ONNX Runtime on the
+# same inputs (recorded while running the pipeline on T1 images, by default
+# on synthetic variants of the example brain), then the whole pipeline.
+#
+# Usage:
+#   python hippodeep_onnx.py --export               # needs the onnx and onnxscript packages
+#   python hippodeep_onnx.py --benchmark [T1 ...]   # needs onnxruntime
+#
+
+import os, sys
+import json
+import time
+import argparse
+import numpy as np
+import torch
+
+from hippodeep_cache import files_digest
+
+BACKENDS = ["torch", "onnx"]
+ONNX_NAMES = ["head", "affine", "hippo"]
+OPSET = 20
+
+
+try: scriptpath = sys._MEIPASS # when running frozen with pyInstaller
+except: scriptpath = os.path.dirname(os.path.realpath(__file__))
+
+onnx_dir = os.path.join(scriptpath, "torchparams")
+
+def onnx_filename(name):
+    return os.path.join(onnx_dir, "hippodeep_%s.onnx" % name)
+
+
+class OnnxNetwork(object):
+    " an ONNX Runtime session called like the torch network it was exported from (torch tensors in and out) "
+    def __init__(self, filename, threads=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads # 0: all the CPU cores
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(filename, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        outputs = [torch.from_numpy(o) for o in self.session.run(None, {self.input_name: np.ascontiguousarray(x.cpu().numpy())})]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+def load_onnx(params, threads=0):
+    " the ONNX Runtime (head, affine, hippo) networks exported from the weights files params "
+    try:
+        import onnxruntime # only imported by the onnx backend, a few 10ms
+    except ImportError:
+        raise RuntimeError("the onnx backend needs onnxruntime (pip install onnxruntime)")
+    try:
+        info = json.load(open(os.path.join(onnx_dir, "onnx.json")))
+    except (OSError, ValueError):
+        info = {}
+    if info.get("weights") != files_digest(params):
+        raise RuntimeError("no ONNX networks exported from the current weights, run: python hippodeep_onnx.py --export")
+    return [OnnxNetwork(onnx_filename(n), threads) for n in ONNX_NAMES]
+
+
+def export():
+    from model_apply_head_and_hippo import HippoDeepPipeline, params_head, params_affine, params_hippo
+    pipeline = HippoDeepPipeline(verbose=False, frozen=False)
+    nets = [pipeline.net, pipeline.netAff, pipeline.hipponet]
+    examples = [torch.zeros(1, 1, 64, 64, 64), torch.zeros(1, 2, 64, 64, 64), torch.zeros(2, 1, 48, 72, 64)]
+    batch = [None, None, ({0: torch.export.Dim("batch")},)]
+    for name, net, example, dynamic in zip(ONNX_NAMES, nets, examples, batch):
+        torch.onnx.export(net, (example,), onnx_filename(name), input_names=["x"], opset_version=OPSET,
+                          dynamo=True, dynamic_shapes=dynamic, external_data=False, verbose=False)
+        print("Saved " + onnx_filename(name))
+    info = dict(weights=files_digest([params_head, params_affine, params_hippo]), opset=OPSET, torch=torch.__version__)
+    json.dump(info, open(os.path.join(onnx_dir, "onnx.json"), "w"))
+
+def timeit(fn, inputs, repeat=3):
+    " the median time of fn over inputs (after a warm-up call), and the outputs "
+    fn(inputs[0])
+    times, outputs = [], []
+    for x in inputs:
+        t = []
+        for r in range(repeat):
+            t0 = time.perf_counter()
+            y = fn(x)
+            t.append(time.perf_counter() - t0)
+        times.append(np.median(t))
+        outputs.append(y)
+    return float(np.median(times)), outputs
+
+def benchmark(fnames):
+    from model_apply_head_and_hippo import HippoDeepPipeline, LoadedImage
+    from hippodeep_precision import calibration_images, record_inputs
+    import nibabel, onnxruntime
+    if fnames:
+        images = [(f, LoadedImage(nibabel.load(f)), None) for f in fnames]
+    else:
+        images = calibration_images(seed=1)
+    pipelines = dict((b, HippoDeepPipeline(verbose=False, frozen=False, backend=b)) for b in BACKENDS)
+    inputs = record_inputs(pipelines["torch"], images)
+
+    print("ONNX Runtime %s, torch %s, %d threads" % (onnxruntime.__version__, torch.__version__, torch.get_num_threads()))
+    print("%-10s %9s %9s %8s %10s" % ("network", "torch", "onnx", "speedup", "max diff"))
+    for name, attr in zip(ONNX_NAMES, ["net", "netAff", "hipponet"]):
+        with torch.no_grad():
+            t_torch, y_torch = timeit(getattr(pipelines["torch"], attr), inputs[name])
+            t_onnx, y_onnx = timeit(getattr(pipelines["onnx"], attr), inputs[name])
+        first = lambda y: y[0] if isinstance(y, tuple) else y
+        diff = max(float((first(a) - first(b)).abs().max()) for a, b in zip(y_torch, y_onnx))
+        print("%-10s %8.3fs %8.3fs %7.2fx %10.2g" % (name, t_torch, t_onnx, t_torch / t_onnx, diff))
+
+    print("%-24s %9s %9s %8s %8s" % ("pipeline", "torch", "onnx", "dL%", "dR%"))
+    for name, data, affine in images:
+        t, res = {}, {}
+        for b, pipeline in pipelines.items():
+            t[b], [res[b]] = timeit(lambda x: pipeline.process(x, affine), [data], repeat=1)
+        deltas = [100. * (res["onnx"][k] - res["torch"][k]) / res["torch"][k] for k in ["hippoL", "hippoR"]]
+        print("%-24s %8.2fs %8.2fs %+8.3f %+8.3f" % ((os.path.basename(name)[-24:], t["torch"], t["onnx"]) + tuple(deltas)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ONNX export and ONNX Runtime benchmark of the HippoDeep networks")
+    parser.add_argument("fnames", nargs="*", metavar="T1", help="images for --benchmark (default: synthetic variants of the example brain)")
+    parser.add_argument("--export", action="store_true", help="export the networks as torchparams/hippodeep_*.onnx")
+    parser.add_argument("--benchmark", action="store_true", help="compare torch and ONNX Runtime on the same inputs")
+    parser.add_argument("--threads", type=int, default=0, help="CPU threads of both backends (default: torch's default)")
+    args = parser.parse_args()
+    if not (args.export or args.benchmark):
+        parser.error("nothing to do, use --export and/or --benchmark")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.export:
+        export()
+    if args.benchmark:
+        benchmark(args.fnames)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+#
+# NIfTI writing for the HippoDeep outputs, and their filenames
+#
+# nibabel.save() gzips with a single thread, at level 1. Here the image is
+# serialized in memory, then compressed at the requested level, by blocks
+# in parallel when threads > 1: each block is an independent gzip member,
+# and concatenated members are a valid gzip file (as made by bgzip or
+# pigz --independent) that nibabel, FSL, ITK and gunzip read as usual.
+#
+
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 1 << 20
+INPUT_EXTENSIONS = [".nii.gz", ".nii", ".mnc"]
+
+
+def subject_base(fname):
+    " fname without its image extension (only .nii.gz, .nii or .mnc), which the names of all its outputs start with "
+    for ext in INPUT_EXTENSIONS:
+        if fname.endswith(ext):
+            return fname[:-len(ext)]
+    return fname
+
+def gzip_bytes(data, level=1, threads=1):
+    " gzip data, by blocks of BLOCK_SIZE compressed in parallel with threads > 1 "
+    # mtime=0: the same image always gives the same file
+    if threads <= 1 or len(data) <= BLOCK_SIZE:
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    view = memoryview(data)
+    blocks = [view[i:i + BLOCK_SIZE] for i in range(0, len(data), BLOCK_SIZE)]
+    # zlib releases the GIL while compressing
+    with ThreadPoolExecutor(threads) as executor:
+        return b"".join(executor.map(lambda block: gzip.compress(block, compresslevel=level, mtime=0), blocks))
+
+def write_nifti(img, filename, level=1, threads=1):
+    " write a nibabel NIfTI image as filename, gzipped if it ends with .gz "
+    data = img.to_bytes()
+    if filename.endswith(".gz"):
+        data = gzip_bytes(data, level, threads)
+    with open(filename, "wb") as f:
+        f.write(data)
@@ -0,0 +1,86 @@
+#
+# Per-stage profiling of HippoDeep
+#
+# Every stage of a subject (load, normalise, head network, native brain mask,
+# affine network, hippocampus crop, hippocampus network, back-projection,
+# NIfTI writes, PDF report) records its wall time, CPU time (of the whole
+# process, i.e. of all torch threads) and the change of the resident memory.
+# One JSON object per subject is appended to the profile file, e.g.
+#   {"subject": "sub01_T1w.nii.gz", "pid": 1234, "threads": 8, "batch": 1,
+#    "stages": {"load": {"wall": 0.41, "cpu": 0.40, "rss_mb": 112.3}, ...},
+#    "wall": 3.52, "cpu": 9.87, "rss_max_mb": 1034.2}
+# (rss_max_mb being the largest resident memory seen at the end of a stage)
+# Stages run once for a whole batch (hippo) are reported for each of its subjects.
+# With --prefetch, the writes (and reports) of a subject run in a background
+# thread while the next subjects are processed: the CPU time of overlapping
+# stages is counted in each of them, so the cpu values are not additive
+# then, and the records say "overlapped": true. (The CPU time of the thread
+# alone, time.thread_time(), would miss the torch and gzip worker threads.)
+#
+
+import os, sys
+import json
+import time
+import threading
+import contextlib
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def rss_mb():
+    " current resident memory of this process "
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / (1024.*1024)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024.*1024)
+    except (OSError, ValueError, IndexError):
+        import resource # then the peak, not the current, resident memory
+        return resource.getrusage(resource.RUSAGE_SELF)[2] / (1024. if sys.platform != "darwin" else 1024.*1024)
+
+
+class StageProfiler(object):
+    " collects the stage timings of subjects and appends them as JSON lines to filename "
+    def __init__(self, filename, overlapped=False):
+        " overlapped: whether stages run concurrently in several threads (--prefetch) "
+        self.filename = filename
+        self.overlapped = overlapped
+        self.lock = threading.Lock()
+
+    def new(self):
+        " the (empty) profile of a subject "
+        return dict(stages={}, rss_max_mb=rss_mb())
+
+    @contextlib.contextmanager
+    def stage(self, profiles, name):
+        " time the enclosed block as stage `name` of each of the profiles "
+        rss0, cpu0, t0 = rss_mb(), time.process_time(), time.perf_counter()
+        try:
+            yield
+        finally:
+            t, cpu, rss = time.perf_counter() - t0, time.process_time() - cpu0, rss_mb()
+            for p in profiles:
+                st = p["stages"].setdefault(name, dict(wall=0., cpu=0., rss_mb=0.))
+                st["wall"] += t
+                st["cpu"] += cpu
+                st["rss_mb"] += rss - rss0
+                p["rss_max_mb"] = max(p["rss_max_mb"], rss)
+
+    def write(self, subject, profile):
+        " append the profile of a subject; its other entries (threads, batch) are copied as they are "
+        rec = dict(subject=subject, pid=os.getpid())
+        rec.update((k, v) for k, v in profile.items() if k not in ("stages", "rss_max_mb"))
+        rec["stages"] = dict((k, dict((m, round(v, 4)) for m, v in st.items())) for k, st in profile["stages"].items())
+        rec["wall"] = round(sum(st["wall"] for st in profile["stages"].values()), 4)
+        rec["cpu"] = round(sum(st["cpu"] for st in profile["stages"].values()), 4)
+        rec["rss_max_mb"] = round(profile["rss_max_mb"], 1)
+        if self.overlapped:
+            rec["overlapped"] = True
+        line = json.dumps(rec) + "\n"
+        # a single append per line, so that pool workers can share the file
+        with self.lock:
+            with open(self.filename, "a") as f:
+                f.write(line)
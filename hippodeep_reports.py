@@ -0,0 +1,115 @@
+#
+# PDF reports of already processed HippoDeep subjects, in parallel
+#
+# Renders the report of every processed T1 image found in the given
+# directories, globs or filenames, from the outputs written next to it
+# (masks and _hippoLR_volumes.csv), so that the segmentation can run with
+# --no-report and leave the reports to this separate step. The subjects are
+# shared among a pool of processes; each failure is listed with its reason,
+# and the exit status is 1 if there were some.
+#
+# Usage:
+#   python hippodeep_reports.py [--workers N] [--force] DIR|GLOB|T1 ...
+#
+
+import os, sys
+import glob
+import time
+import argparse
+import multiprocessing
+
+from HippoDeepReport import report_from_outputs
+from hippodeep_output import subject_base
+
+VOLUMES_SUFFIX = "_hippoLR_volumes.csv"
+
+
+def t1_of(csvname):
+    " the T1 image of a volumes csv, or None if there is none next to it "
+    base = csvname[:-len(VOLUMES_SUFFIX)]
+    for ext in [".nii.gz", ".nii"]:
+        if os.path.exists(base + ext):
+            return base + ext
+    return None
+
+def find_subjects(args):
+    """
+    The T1 images of args: the processed subjects (with a volumes csv) of
+    the directories and globs, and the T1 filenames as given.
+    Returns the images and the (name, reason) of the volumes csvs without one.
+    """
+    fnames, missing = [], []
+    for arg in args:
+        if os.path.isdir(arg):
+            csvs = glob.glob(os.path.join(glob.escape(arg), "*" + VOLUMES_SUFFIX))
+        elif glob.has_magic(arg):
+            # the T1 images matched, or their csvs: only the processed ones
+            matched = glob.glob(arg)
+            csvs = [f for f in matched if f.endswith(VOLUMES_SUFFIX)]
+            csvs += [subject_base(f) + VOLUMES_SUFFIX for f in matched if f.endswith((".nii", ".nii.gz"))]
+            csvs = [f for f in csvs if os.path.exists(f)]
+        else:
+            fnames.append(arg)
+            continue
+        for csvname in sorted(set(csvs)):
+            t1 = t1_of(csvname)
+            if t1 is None:
+                missing.append((csvname, "no T1 image next to it"))
+            else:
+                fnames.append(t1)
+    # keep the first of duplicates
+    return list(dict.fromkeys(fnames)), missing
+
+def pdf_uptodate(fname):
+    " whether the report of fname exists and is newer than its volumes csv "
+    base = subject_base(fname)
+    try:
+        return os.path.getmtime(base + ".pdf") > os.path.getmtime(base + VOLUMES_SUFFIX)
+    except OSError:
+        return False
+
+def render(fname):
+    " report one subject in a pool worker; returns (fname, pdf filename or None, failure reason, time) "
+    t0 = time.time()
+    try:
+        return fname, report_from_outputs(fname), None, time.time() - t0
+    except Exception as e:
+        return fname, None, "%s: %s" % (type(e).__name__, e), time.time() - t0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the PDF reports of T1 images already processed by HippoDeep")
+    parser.add_argument("inputs", nargs="+", metavar="DIR|GLOB|T1", help="directories or (quoted) globs of processed subjects, or T1 images")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--force", action="store_true", help="also regenerate the reports already newer than the volumes csv")
+    args = parser.parse_args(argv)
+
+    fnames, failed = find_subjects(args.inputs)
+    if not args.force:
+        skipped = [f for f in fnames if pdf_uptodate(f)]
+        fnames = [f for f in fnames if f not in set(skipped)]
+        if skipped:
+            print("Skipping %d subject(s) whose report is up to date (--force to regenerate)" % len(skipped))
+    print("Generating %d report(s) with %d worker(s)" % (len(fnames), max(1, min(args.workers, len(fnames)))))
+
+    done = 0
+    if fnames:
+        with multiprocessing.Pool(max(1, min(args.workers, len(fnames)))) as pool:
+            for fname, pdf, reason, t in pool.imap(render, fnames):
+                if pdf is None:
+                    failed.append((fname, reason))
+                    print(" %s: failed, %s" % (fname, reason))
+                else:
+                    done += 1
+                    print(" %s (%.2fs)" % (pdf, t))
+
+    print("Done: %d report(s) generated, %d failure(s)" % (done, len(failed)))
+    for fname, reason in failed:
+        print("  %s: %s" % (fname, reason))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support() # for the pyInstaller executable
+    main()
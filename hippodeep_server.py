@@ -0,0 +1,200 @@
+#
+# Persistent HippoDeep segmentation server
+#
+# Loads the head, MNI-affine and hippocampus networks once, then serves jobs
+# (a NIfTI filename in, volumes and output filenames back), so that short
+# jobs don't pay the interpreter, torch import and weights loading each time.
+#
+# Usage:
+#   python hippodeep_server.py --socket /tmp/hippodeep.sock   # Unix-domain socket
+#   python hippodeep_server.py --http 8765                    # http://127.0.0.1:8765
+#   (with the pipeline options of model_apply_head_and_hippo.py, e.g. --outputs, --precision)
+#   python hippodeep_server.py --socket /tmp/hippodeep.sock --submit subject_*.nii.gz
+#
+# Unix socket protocol: one JSON object per line, answered by one JSON line
+#   {"path": "/data/sub01_T1w.nii.gz"}          (optional: "report": false)
+#   {"cmd": "status"}
+# HTTP: POST /process with the same JSON body, GET /status
+#
+# Requests are accepted concurrently and queued; they are run one at a time,
+# each using all the torch threads. Every reply carries the current queue depth.
+#
+
+import os, sys
+import json
+import queue
+import signal
+import socket
+import argparse
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class JobQueue(object):
+    " FIFO of segmentation jobs, run in order by a single worker thread on the shared pipeline "
+    def __init__(self, pipeline, report=True):
+        self.pipeline = pipeline
+        self.report = report
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.running, self.done, self.failed = 0, 0, 0
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def status(self):
+        with self.lock:
+            return dict(status="ok", queued=self.jobs.qsize(), running=self.running, done=self.done, failed=self.failed)
+
+    def handle(self, job):
+        " dispatch one decoded request, blocking until its reply is ready "
+        if not isinstance(job, dict):
+            return dict(status="error", error="expected a JSON object")
+        if job.get("cmd") == "status":
+            return self.status()
+        if "path" not in job:
+            return dict(status="error", error="missing 'path'")
+        if not isinstance(job["path"], str) or not job["path"]:
+            return dict(status="error", error="'path' must be a non-empty string")
+        done = threading.Event()
+        slot = {}
+        self.jobs.put((job, done, slot))
+        done.wait()
+        reply = slot["reply"]
+        reply["queued"] = self.jobs.qsize()
+        return reply
+
+    def _worker(self):
+        while True:
+            job, done, slot = self.jobs.get()
+            with self.lock:
+                self.running = 1
+            try:
+                slot["reply"] = self._run(job)
+            except Exception as e:
+                slot["reply"] = dict(status="error", path=job["path"], error="%s: %s" % (type(e).__name__, e))
+            with self.lock:
+                self.running = 0
+                if slot["reply"]["status"] == "ok":
+                    self.done += 1
+                else:
+                    self.failed += 1
+            done.set()
+
+    def _run(self, job):
+        from model_apply_head_and_hippo import run_subject
+        fname = job["path"]
+        res = run_subject(self.pipeline, fname, report=bool(job.get("report", self.report)))
+        if res is None:
+            return dict(status="error", path=fname, error="can't open the file")
+        return dict(status="ok", path=fname, eTIV=float(res["eTIV"]),
+                    hippoL=float(res["hippoL"]), hippoR=float(res["hippoR"]),
+                    outputs=res["outputs"], warnings=[w.strip() for w in res["warnings"]])
+
+
+class UnixJobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line.decode("utf-8"))
+            except ValueError:
+                reply = dict(status="error", error="invalid JSON")
+            else:
+                reply = self.server.jobqueue.handle(job)
+            self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+class HTTPJobHandler(BaseHTTPRequestHandler):
+    def _reply(self, code, reply):
+        body = (json.dumps(reply) + "\n").encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/status":
+            self._reply(200, self.server.jobqueue.status())
+        else:
+            self._reply(404, dict(status="error", error="unknown path"))
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/process":
+            return self._reply(404, dict(status="error", error="unknown path"))
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+        except ValueError:
+            return self._reply(400, dict(status="error", error="invalid JSON"))
+        reply = self.server.jobqueue.handle(job)
+        self._reply(200 if reply["status"] == "ok" else 400, reply)
+
+    def log_message(self, format, *args):
+        pass # the pipeline already prints one block per subject
+
+
+def serve(socketpath=None, port=None, report=True, settings=None):
+    " serve jobs on the Unix socket socketpath, or on HTTP port, with a HippoDeepPipeline(**settings) "
+    from model_apply_head_and_hippo import HippoDeepPipeline
+    jobqueue = JobQueue(HippoDeepPipeline(**(settings or {})), report=report)
+    if socketpath:
+        if os.path.exists(socketpath):
+            os.remove(socketpath)
+        server = socketserver.ThreadingUnixStreamServer(socketpath, UnixJobHandler)
+        print("HippoDeep server listening on " + socketpath)
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", port), HTTPJobHandler)
+        print("HippoDeep server listening on http://127.0.0.1:%d" % port)
+    server.daemon_threads = True
+    server.jobqueue = jobqueue
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0)) # still remove the socket file when killed
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socketpath and os.path.exists(socketpath):
+            os.remove(socketpath)
+
+
+def submit(socketpath, fnames, report=True):
+    " send jobs to a running server over its Unix socket, yields the replies "
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(socketpath)
+    f = s.makefile("rwb")
+    for fname in fnames:
+        f.write((json.dumps(dict(path=os.path.abspath(fname), report=report)) + "\n").encode("utf-8"))
+        f.flush()
+        yield json.loads(f.readline().decode("utf-8"))
+    f.close()
+    s.close()
+
+
+def main():
+    from model_apply_head_and_hippo import add_pipeline_arguments, pipeline_settings
+    parser = argparse.ArgumentParser(description="HippoDeep segmentation server")
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument("--socket", help="path of the Unix-domain socket")
+    where.add_argument("--http", type=int, metavar="PORT", help="serve HTTP on 127.0.0.1:PORT")
+    parser.add_argument("--submit", nargs="+", metavar="T1", help="client mode: send these files to a running server (--socket only)")
+    add_pipeline_arguments(parser) # of the server (--no-report also applies to --submit)
+    args = parser.parse_args()
+
+    if args.submit:
+        if not args.socket:
+            parser.error("--submit requires --socket")
+        failed = 0
+        for reply in submit(args.socket, args.submit, report=not args.no_report):
+            print(json.dumps(reply))
+            failed += reply["status"] != "ok"
+        sys.exit(1 if failed else 0)
+
+    settings = pipeline_settings(args)
+    serve(args.socket, args.http, report="report" in args.outputs, settings=settings)
+
+
+if __name__ == "__main__":
+    main()
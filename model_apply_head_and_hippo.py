@@ -2,16 +2,24 @@ import torch
 import nibabel
 import numpy as np
 import os, sys, time
-import scipy.ndimage
+import io, argparse, contextlib, multiprocessing
+import collections, itertools, functools
+from concurrent.futures import ThreadPoolExecutor
 import torch.nn as nn
 import torch.nn.functional as F
 from numpy.linalg import inv
 if sys.platform=="win32": import psutil # this works for Windows
 else: import resource # Unix specific package, does not exist for Windoze
-try: from GetFilename import GetFilename
-except: pass
-try: from HippoDeepReport import HippoDeepReport
-except: pass
+# GetFilename (tkinter), HippoDeepReport (PIL, fpdf) and scipy are imported where
+# they are used, so that segmenting files given on the command line without
+# reports doesn't load them
+from hippodeep_cache import ResultCache, files_digest
+from hippodeep_profile import StageProfiler
+from hippodeep_output import write_nifti, subject_base
+from hippodeep_export import load_frozen, frozen_info
+from hippodeep_precision import PRECISIONS, reduced_precision, load_int8, export as export_int8
+from hippodeep_onnx import BACKENDS, load_onnx
+from hippodeep_geometry import GeometryCache
 
 # monkey-patch for back-compatibility with older (~1.0.0) torch
 import inspect
@@ -19,16 +27,6 @@ if not "align_corners" in inspect.signature(F.grid_sample).parameters:
     old_grid_sample = torch.nn.functional.grid_sample
     F.grid_sample = lambda *x, **k : old_grid_sample(*x)
 
-if len(sys.argv[1:]) == 0:
-  try: sys.argv.append(GetFilename())
-  except:
-    print("Need to pass one or more T1 image filename as argument")
-    sys.exit(1)
-
-print("Using all available CPU threads")
-if 0: # otherwise, set a limit (useful for running multiple instances)
-    torch.set_num_threads(4)
-
 
 class HeadModel(nn.Module):
     def __init__(self):
@@ -71,41 +69,39 @@ class HeadModel(nn.Module):
 
     def forward(self, x):
         x = F.elu(self.conv0a(x))
-        self.li0 = x = F.elu(self.bn0a(self.conv0b(x)))
+        li0 = x = F.elu(self.bn0a(self.conv0b(x)))
 
         x = self.ma1(x)
         x = F.elu(self.conv1a(x))
-        self.li1 = x = F.elu(self.bn1a(self.conv1b(x)))
+        li1 = x = F.elu(self.bn1a(self.conv1b(x)))
 
         x = self.ma2(x)
         x = F.elu(self.conv2a(x))
-        self.li2 = x = F.elu(self.bn2a(self.conv2b(x)))
+        li2 = x = F.elu(self.bn2a(self.conv2b(x)))
 
         x = self.ma3(x)
         x = F.elu(self.conv3a(x))
-        self.li3 = x = F.elu(self.bn3a(self.conv3b(x)))
+        x = F.elu(self.bn3a(self.conv3b(x)))
 
         x = F.interpolate(x, scale_factor=2, mode="nearest")
 
         x = F.elu(self.conv2u(x))
-        x = torch.cat([x, self.li2], 1)
+        x = torch.cat([x, li2], 1)
         x = F.elu(self.bn2u(self.conv2v(x)))
 
-        self.lo1 = x
         x = F.interpolate(x, scale_factor=2, mode="nearest")
 
         x = F.elu(self.conv1u(x))
-        x = torch.cat([x, self.li1], 1)
+        x = torch.cat([x, li1], 1)
         x = F.elu(self.bn1u(self.conv1v(x)))
 
         x = F.interpolate(x, scale_factor=2, mode="nearest")
-        self.la1 = x
 
         x = F.elu(self.conv0u(x))
-        x = torch.cat([x, self.li0], 1)
+        x = torch.cat([x, li0], 1)
         x = F.elu(self.bn0u(self.conv0v(x)))
 
-        self.out = x = self.conv1x(x)
+        x = self.conv1x(x)
         x = torch.sigmoid(x)
         return x
 
@@ -161,9 +157,11 @@ class ModelAff(nn.Module):
         gout = F.grid_sample(outc1, wgrid[...,[2,1,0]], align_corners=True)
         return gout, self.tA
 
-    def resample_other(self, other):
+    def resample_other(self, other, tA=None):
+        " warp another 64^3 volume with the affine of the last forward() call (or tA) "
+        if tA is None: tA = self.tA
         with torch.no_grad():
-            wgrid = self.grid @ self.tA[:,None,None]
+            wgrid = self.grid @ tA[:,None,None]
             gout = F.grid_sample(other, wgrid[...,[2,1,0]], align_corners=True)
             return gout
 
@@ -187,18 +185,6 @@ np.array([[  -2.85714293,   -0.        ,    0.        ,   90.        ],
 try: scriptpath = sys._MEIPASS # when running frozen with pyInstaller 
 except: scriptpath = os.path.dirname(os.path.realpath(__file__))
 
-device = torch.device("cpu")
-net = HeadModel()
-net.to(device)
-net.load_state_dict(torch.load(os.path.normpath(scriptpath + "/torchparams/params_head_00075_00000.pt"), map_location=device))
-net.eval()
-
-netAff = ModelAff()
-netAff.load_state_dict(torch.load(os.path.normpath(scriptpath + "/torchparams/paramsaffineta_00079_00000.pt"), map_location=device), strict=False)
-netAff.to(device)
-netAff.eval()
-
-
 
 class HippoModel(nn.Module):
     def __init__(self):
@@ -242,51 +228,95 @@ class HippoModel(nn.Module):
         x = F.relu(self.conv0a_0(x))
         x = F.relu(self.conv0a_1(x))
         x = F.relu(self.conv0a(x))
-        self.out_conv_f1 = x = F.relu(self.convf1(x))
+        out_conv_f1 = x = F.relu(self.convf1(x))
         
-        self.out_maxpool1 = x = self.maxpool1(x)
+        out_maxpool1 = x = self.maxpool1(x)
         x = self.bn1(x)
         x = F.relu(self.convout0(x))
         x = self.convout1(x)
-        x = x + self.out_maxpool1
+        x = x + out_maxpool1
         x = F.relu(x)
 
-        self.out_maxpool2 = x = self.maxpool2(x)
+        out_maxpool2 = x = self.maxpool2(x)
         x = self.bn2(x)
         x = F.relu(self.convout2p(x))
         x = self.convout2(x)
-        x = x + self.out_maxpool2
+        x = x + out_maxpool2
         x = F.relu(x)
 
-        self.lx2 = F.interpolate(x, scale_factor=2, mode="nearest")
-
         x = F.relu(self.convlx3(x))
         x = F.interpolate(x, scale_factor=2, mode="nearest")
         x = F.relu(self.convlx5(x))
         x = F.interpolate(x, scale_factor=2, mode="nearest")
         x = F.relu(self.convlx7(x))
-        self.out_output1 = x = torch.sigmoid(self.convlx8(x))
+        out_output1 = x = torch.sigmoid(self.convlx8(x))
 
         x = torch.sigmoid(self.blur(x))
-        x = x * self.out_conv_f1
+        x = x * out_conv_f1
         x = F.leaky_relu(self.conv_extract(x))
-        x = torch.cat([self.out_output1, x], dim=1)
+        x = torch.cat([out_output1, x], dim=1)
         
         x = F.relu(self.convmix(x))
-        self.out_output2 = x = torch.sigmoid(self.convout1x(x))    
-        #x = torch.cat([self.out_output2, self.out_output1], dim=1)
+        x = torch.sigmoid(self.convout1x(x))    
+        #x = torch.cat([out_output2, out_output1], dim=1)
 
         return x
 
-hipponet = HippoModel()
-hipponet.load_state_dict(torch.load(scriptpath + "/torchparams/hippodeep.pt"))
-
 
-OUTPUT_RES64 = False
-OUTPUT_NATIVE = True
-OUTPUT_DEBUG = False
 
-allsubjects_scalar_report = []
+# the products of HippoDeep (--outputs): by default the volumes csv, the
+# native-space brain and hippocampus masks and the PDF report; the others are
+# for other tools (ANTs) or for debugging
+PRODUCTS = collections.OrderedDict([
+    ("volumes", "eTIV and hippocampal volumes (_hippoLR_volumes.csv), always written"),
+    ("mask_L", "left hippocampus mask (in the --mask-format)"),
+    ("mask_R", "right hippocampus mask (in the --mask-format)"),
+    ("brain_mask", "native-space brain mask (_brain_mask)"),
+    ("report", "PDF report (.pdf)"),
+    ("etiv_txt", "eTIV in the 64^3 box (_eTIV.txt)"),
+    ("ants_affine", "native to MNI affine transform for antsApplyTransforms -t (_mni0Affine.txt)"),
+    ("ants_rigid", "rigid part of that transform (_mni0Rigid.txt)"),
+    ("mniwrap", "T1 image in the MNI 64^3 box (_mniwrap)"),
+    ("mniwrapc1", "brain prior in the MNI 64^3 box (_mniwrapc1)"),
+    ("cerebrum_mask", "native-space cerebrum mask (_cerebrum_mask)"),
+    ("cortex", "native-space cortex prior (_tissues1)"),
+    ("tissues64", "brain and cortex (and with cerebrum_mask, cerebrum) priors in the 64^3 box (_tissues*_b64)"),
+    ("orig_b64", "normalized T1 image in the 64^3 box (_orig_b64)"),
+    ("affcrop", "T1 image in the hippocampus box (_affcrop)"),
+    ("affcrop_seg", "hippocampus segmentation in the hippocampus box (_affcrop_outseg_mask)"),
+    ("scalars", "every volume computed by the pipeline (_scalars_hippo.csv)"),
+])
+DEFAULT_OUTPUTS = ["volumes", "mask_L", "mask_R", "brain_mask", "report"]
+# the products needing the native-space hippocampus masks, without which
+# only the volumes are computed (see crop_volumes())
+MASK_PRODUCTS = set(["mask_L", "mask_R", "report"])
+# the products written from the results of process() (so also from cached
+# results), the others are written while processing
+SAVED_PRODUCTS = set(DEFAULT_OUTPUTS)
+
+# the optional stages needed by each product (or stage); the stages that no
+# requested product needs are skipped
+REQUIRES = dict(brain_mask=["brainmask_native"], report=["brainmask_native"],
+                cerebrum_mask=["cerebrum_native"], scalars=["brainmask_native", "cerebrum_native"])
+
+def required(outputs):
+    " the products of outputs and every stage they need "
+    needed, todo = set(), list(outputs)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(REQUIRES.get(name, []))
+    return needed
+
+def parse_outputs(text):
+    " the products of a comma separated --outputs list, where 'default' stands for DEFAULT_OUTPUTS "
+    outputs = set(["volumes"])
+    for name in filter(None, text.split(",")):
+        outputs.update(DEFAULT_OUTPUTS if name == "default" else [name])
+    if outputs - set(PRODUCTS):
+        raise argparse.ArgumentTypeError("unknown outputs %s (choose among: %s)" % (", ".join(sorted(outputs - set(PRODUCTS))), ", ".join(PRODUCTS)))
+    return outputs
 
 mul_homo = lambda g, Mt : g @ Mt[:3,:3].astype(np.float32) + Mt[3,:3].astype(np.float32)
 
@@ -299,362 +329,1108 @@ def indices_unitary(dimensions, dtype):
         res[i] = np.linspace(-1, 1, dim, dtype=dtype).reshape( shape[:i] + (dim,) + shape[i+1:]  )
     return res
 
-for fname in sys.argv[1:]:
-    Ti = time.time()
-    try:
-        print("Loading image " + fname)
-        outfilename = fname.replace(".mnc", ".nii").replace(".nii.gz", ".nii").replace(".nii", "_tiv.nii.gz")
-        img = nibabel.load(fname)
-
-        if img.header["qform_code"] == 0:
-            print(" *** Warning: the header of this nifti file has no qform_code defined.")
-            print(" Fix the header manually or reconvert from the original DICOM.")
-            #if not OUTPUT_DEBUG:
-            #    continue
-    except:
-        open(fname + ".warning.txt", "a").write("can't open the file\n")
-        print(" *** Error: can't open file. Skip")
-        continue
-
+def volume_stats(data, slab_voxels=1 << 22):
+    " mean and standard deviation (as float32) of an array, in a single pass over slabs, accumulated in float64 "
+    flat = data.reshape(-1, order="A") if data.flags.f_contiguous or data.flags.c_contiguous else data.ravel()
+    total, total2 = 0., 0.
+    for i in range(0, flat.size, slab_voxels):
+        slab = flat[i:i + slab_voxels].astype(np.float64)
+        total += slab.sum()
+        total2 += np.dot(slab, slab)
+    mean = total / flat.size
+    return np.float32(mean), np.float32(np.sqrt(max(total2 / flat.size - mean * mean, 0.)))
+
+def inbounds_weight(grid, shape):
+    " for grid_sample(align_corners=True) of an input of spatial shape (D,H,W), the total weight given to the voxels within the input "
+    weight = None
+    for axis, n in enumerate(shape[::-1]): # the grid is (x,y,z) = (W,H,D)
+        idx = (grid[...,axis] + 1) / 2 * (n - 1)
+        i0 = torch.floor(idx)
+        f = idx - i0
+        w = (1 - f) * ((i0 >= 0) & (i0 <= n - 1)) + f * ((i0 >= -1) & (i0 <= n - 2))
+        weight = w if weight is None else weight * w
+    return weight
+
+def grid_sample_normalized(data, grid, mean, std):
+    """
+    grid_sample (trilinear, zero padding, align_corners) of (data - mean) / std,
+    without making the normalized copy of the (whole) data: as the sampling
+    is linear, it is (sample(data) - mean * sample(1)) / std, where sample(1)
+    is the weight of the voxels within the input (1 but near its edges).
+    """
+    out = F.grid_sample(torch.as_tensor(data, dtype=torch.float32, device=grid.device)[None,None], grid, align_corners=True)
+    out -= mean * inbounds_weight(grid, data.shape)[:,None]
+    out /= std
+    return out
+
+@functools.lru_cache(maxsize=None)
+def hippo_crop_grid():
+    " the [-1,1]^3 (x,y,z) grid of the hippocampus box, built once "
+    sgrid = np.rollaxis(indices_unitary(imgcroproi_shape, dtype=np.float32),0,4)
+    sgrid.flags.writeable = False
+    return sgrid
+
+@functools.lru_cache(maxsize=None)
+def mni_box_matrix():
+    " the matrix of the MNI 64^3 box world coordinates to [-1,1]^3, computed once "
+    wmni = np.linalg.lstsq(bbox_world(affine64_mni, (64,64,64)), bbox_one, rcond=None)[0]
+    wmni.flags.writeable = False
+    return wmni
+
+def native_grids(shape, revaff1i, device, slab_voxels=1 << 22):
+    """
+    The sampling grids of native_slabs(), one slab of the first axis at a
+    time: yields (x0, x1, grid of the voxels [x0:x1]).
+    The coordinates are the (float16) ones of indices_unitary() on the whole
+    image, so the result is identical to a single grid_sample over the whole
+    image.
+    """
+    gsx, gsy, gsz = shape
+    linspaces = [np.linspace(-1, 1, dim, dtype=np.float16) for dim in shape]
+    Mt = inv(revaff1i)
+    step = max(1, slab_voxels // (gsy * gsz))
+    for x0 in range(0, gsx, step):
+        x1 = min(gsx, x0 + step)
+        sgrid = np.empty((x1 - x0, gsy, gsz, 3), np.float16)
+        sgrid[...,0] = linspaces[0][x0:x1,None,None]
+        sgrid[...,1] = linspaces[1][None,:,None]
+        sgrid[...,2] = linspaces[2][None,None,:]
+        wgridt = torch.as_tensor(mul_homo(sgrid, Mt)[None,...,[2,1,0]], device=device, dtype=torch.float32)
+        del sgrid
+        yield x0, x1, wgridt
+
+def native_slabs(data, shape, revaff1i, device, slab_voxels=1 << 22, grids=None):
+    """
+    Resample data (an array in the LAS [-1,1]^3 box, e.g. a 64^3 prior) at
+    every voxel of a native image of the given shape, one slab of the first
+    axis at a time: yields (x0, x1, resampled[x0:x1]).
+    The sampling grid of a slab is computed when needed (unless grids, e.g.
+    cached ones, are given), so the memory does not grow with the native
+    image size.
+    """
+    src = torch.as_tensor(data, dtype=torch.float32, device=device)[None,None]
+    if grids is None:
+        grids = native_grids(shape, revaff1i, device, slab_voxels)
+    for x0, x1, wgridt in grids:
+        yield x0, x1, np.asarray(F.grid_sample(src, wgridt, align_corners=True).cpu())[0,0]
+
+def native_resample(data, shape, revaff1i, device, grids=None):
+    " native_slabs() gathered into a single (float32) array "
+    out = np.empty(shape, np.float32)
+    for x0, x1, slab in native_slabs(data, shape, revaff1i, device, grids=grids):
+        out[x0:x1] = slab
+    return out
+
+def bbox_xyz(shape, affine):
+    " returns the worldspace of the edge of the image "
+    s = shape[0]-1, shape[1]-1, shape[2]-1
+    bbox = [[0,0,0], [s[0],0,0], [0,s[1],0], [0,0,s[2]], [s[0],s[1],0], [s[0],0,s[2]], [0,s[1],s[2]], [s[0],s[1],s[2]]]
+    return mul_homo(bbox, affine.T)
+
+def indices_xyz(shape, affine, offset_vox= np.array([0,0,0])):
+    assert (len(shape) == 3)
+    ind = np.indices(shape).astype(np.float32) + offset_vox.reshape(3, 1,1,1).astype(np.float32)
+    return mul_homo(np.rollaxis(ind, 0, 4), affine.T)
+
+def xyz_to_DHW3(xyz, iaffine, srcshape):
+    affine = np.linalg.inv(iaffine)
+    ijk3 = mul_homo(xyz, affine.T)
+    ijk3[...,0] /= srcshape[0] -1
+    ijk3[...,1] /= srcshape[1] -1
+    ijk3[...,2] /= srcshape[2] -1
+    ijk3 = ijk3 * 2 - 1
+    DHW3 = np.swapaxes(ijk3, 0, 2)
+    return DHW3
+
+# hippocampus crop box, in mm (MNI space)
+imgcroproi_affine = np.array([[ -1., -0., 0., 54.], [ -0., 1., -0., -59.], [0., 0., 1., -45.], [0., 0., 0., 1.]])
+imgcroproi_shape = (107, 72, 68)
+
+def native_box(pts, M, img):
+    " the box (first voxel, width) of the native image holding the points pts (in MNI space) "
+    pts = mul_homo(pts, np.linalg.inv(M).T)
+    pts_ijk = mul_homo(pts, np.linalg.inv(img.affine).T)
+    for i in range(3):
+        np.clip(pts_ijk[:,i], 0, img.shape[i], out = pts_ijk[:,i])
+    pmin = np.floor(np.min(pts_ijk, 0)).astype(int)
+    pwidth = np.ceil(np.max(pts_ijk, 0)).astype(int) - pmin
+    return pmin, pwidth
+
+def crop_volumes(output, M, img):
+    """
+    The native-space volumes (mm^3) of the L/R hippocampus crop outputs
+    (0-255 in the crop box), as the back-projection of _backproject() gives
+    them but without its masks: each side is resampled only at the native
+    voxels near its non-zero crop voxels, as the others are 0. The sums are
+    accumulated in float64, so the volumes can differ from the ones of the
+    masks by the float32 rounding of their sums (below 1e-3 mm^3).
+    """
+    pmin0, pwidth0 = native_box(bbox_xyz(imgcroproi_shape, imgcroproi_affine), M, img)
+    vols = []
+    for side in range(2):
+        nz = np.nonzero(output[side])
+        if not len(nz[0]):
+            vols.append(0.)
+            continue
+        # the crop voxels interpolated from non-zero ones, and the native box around them
+        lo = np.min(nz, 1) - 1
+        hi = np.max(nz, 1) + 1
+        corners = np.array([[(lo, hi)[c >> i & 1][i] for i in range(3)] for c in range(8)])
+        tmin, twidth = native_box(mul_homo(corners, imgcroproi_affine.T), M, img)
+        pmin = np.maximum(pmin0, tmin)
+        pend = np.minimum(pmin0 + pwidth0, tmin + twidth + 1)
+        if np.any(pend <= pmin):
+            vols.append(0.)
+            continue
+        widx = indices_xyz(pend - pmin, img.affine, offset_vox=pmin)
+        DHW3 = xyz_to_DHW3(mul_homo(widx, M.T), imgcroproi_affine, imgcroproi_shape)
+        d = torch.tensor(output[side].transpose(2, 1, 0), dtype=torch.float32)
+        dnat = F.grid_sample(d[None,None], torch.tensor(DHW3[None]), align_corners=True)[0,0]
+        dnat[dnat < 32] = 0 # remove noise, as _backproject()
+        vols.append(float(dnat.sum(dtype=torch.float64)) / 255. * np.abs(np.linalg.det(img.affine)))
+    return vols
+
+def ornt_to_las(affine):
+    " orientation transforms from the image axes to LAS and back "
+    o1 = nibabel.orientations.io_orientation(affine)
+    o2 = np.array([[ 0., -1.], [ 1.,  1.], [ 2.,  1.]]) # We work in LAS space (same as the mni_icbm152 template)
+    trn = nibabel.orientations.ornt_transform(o1, o2) # o1 to o2 (apply to o2 to obtain o1)
+    trn_back = nibabel.orientations.ornt_transform(o2, o1)
+    return trn, trn_back
+
+def save_mask(data, img, filename, offset=None, level=1, threads=1):
+    """
+    save an uint8 mask in the space of img, transcribing parameters from its original header.
+    With an offset, data is the box of img starting at that voxel, and is saved as such (with its own affine).
+    level and threads are the gzip compression level and threads (see write_nifti)
+    """
+    affine = img.affine
+    if offset is not None:
+        affine = affine.copy()
+        affine[:3,3] = img.affine[:3,:3] @ offset + img.affine[:3,3]
+    img_out = nibabel.Nifti1Image(data.astype("uint8"), affine)
+    unit_xyz, unit_t = img.header.get_xyzt_units()
+    if unit_xyz == 'unknown': unit_xyz=0
+    if unit_t   == 'unknown': unit_t=0
+    img_out.header.set_xyzt_units(unit_xyz, unit_t)
+    img_out.set_sform(affine, code=int(img.header['sform_code']))
+    img_out.set_qform(affine, code=int(img.header['qform_code']))
+    write_nifti(img_out, filename, level, threads)
+
+def load_volume(img):
+    """
+    The data of img as float32, averaged over the last axis if 4D, and the
+    warnings for the subject.
+    4D images are read and summed one frame at a time (from the memory-mapped
+    file when uncompressed), so the memory used doesn't depend on the number
+    of frames. The result is identical to averaging the whole 4D array.
+    """
+    warnings = []
+    if len(img.shape) == 4:
+        warnings.append("dim not 3. Averaging last dimension\n")
+        with contextlib.ExitStack() as stack:
+            frames = img.dataobj
+            if nibabel.is_proxy(frames) and str(frames.file_like).endswith((".gz", ".bz2", ".zst")):
+                # the proxy would decompress the file from its start for every frame: read them from a single stream
+                f = stack.enter_context(nibabel.openers.ImageOpener(frames.file_like))
+                frames = nibabel.arrayproxy.ArrayProxy(f, (frames.shape, frames.dtype, frames.offset, frames.slope, frames.inter))
+            d = np.array(frames[..., 0], dtype=np.float32)
+            for t in range(1, img.shape[3]):
+                d += np.asarray(frames[..., t], dtype=np.float32)
+        d /= img.shape[3]
+        return d, warnings
     d = img.get_fdata(caching="unchanged", dtype=np.float32)
     while len(d.shape) > 3:
-        print("Warning: this looks like a timeserie. Averaging it")
-        open(fname + ".warning.txt", "a").write("dim not 3. Averaging last dimension\n")
+        warnings.append("dim not 3. Averaging last dimension\n")
         d = d.mean(-1)
-
-    d_orig = d
-    d = (d - d.mean()) / d.std()
-    
-    o1 = nibabel.orientations.io_orientation(img.affine)
-    o2 = np.array([[ 0., -1.], [ 1.,  1.], [ 2.,  1.]]) # We work in LAS space (same as the mni_icbm152 template)
-    trn = nibabel.orientations.ornt_transform(o1, o2) # o1 to o2 (apply to o2 to obtain o1)
-    trn_back = nibabel.orientations.ornt_transform(o2, o1)    
-
-    revaff1 = nibabel.orientations.inv_ornt_aff(trn, (1,1,1)) # mult on o1 to obtain o2
-    revaff1i = nibabel.orientations.inv_ornt_aff(trn_back, (1,1,1)) # mult on o2 to obtain o1
-
-    aff_orig64 = np.linalg.lstsq(bbox_world(np.identity(4), (64,64,64)), bbox_world(img.affine, img.shape[:3]), rcond=None)[0].T
-    voxscale_native64 = np.abs(np.linalg.det(aff_orig64))
-    revaff64i = nibabel.orientations.inv_ornt_aff(trn_back, (64,64,64))
-    aff_reor64 = np.linalg.lstsq(bbox_world(revaff64i, (64,64,64)), bbox_world(img.affine, img.shape[:3]), rcond=None)[0].T
-
-    wgridt = (netAff.grid @ torch.tensor(revaff1i, device=device, dtype=torch.float32))[None,...,[2,1,0]]
-    d_orr = F.grid_sample(torch.as_tensor(d, dtype=torch.float32, device=device)[None,None], wgridt, align_corners=True)
-
-    if OUTPUT_DEBUG:
-        nibabel.Nifti1Image(np.asarray(d_orr[0,0].cpu()), aff_reor64).to_filename(outfilename.replace("_tiv", "_orig_b64"))
-
-## Head priors
-    T = time.time()
-    with torch.no_grad():
-        out1t = net(d_orr)
-    out1 = np.asarray(out1t.cpu())
-    #print("Head Inference in ", time.time() - T)
-
-    ## Output head priors
-    scalar_output = []
-    scalar_output_report = []
-
-
-    # brain mask
-    output = out1[0,0].astype("float32")
-
-    out_cc, lab = scipy.ndimage.label(output > .01)
-    #output *= (out_cc == np.bincount(out_cc.flat)[1:].argmax()+1)
-    brainmask_cc = torch.tensor(output)
-
-    vol = (output[output > .5]).sum() * voxscale_native64
-    if OUTPUT_DEBUG:
-        print(" Estimated intra-cranial volume (mm^3): %d" % vol)
-    if 0:
-        open(outfilename.replace("_tiv.nii.gz", "_eTIV.txt"), "w").write("%d\n" % vol)
-    scalar_output.append(vol)
-    scalar_output_report.append(vol)
-
-    if OUTPUT_RES64:
-        out = (output.clip(0, 1) * 255).astype("uint8")
-        nibabel.Nifti1Image(out, aff_reor64, img.header).to_filename(outfilename.replace("_tiv", "_tissues%d_b64" % 0))
-
-    if OUTPUT_NATIVE:
-        # wgridt for native space
-        gsx, gsy, gsz = img.shape[:3]
-        # this is a big array, so use float16
-        sgrid = np.rollaxis(indices_unitary((gsx,gsy,gsz), dtype=np.float16),0,4)
-        wgridt = torch.as_tensor(mul_homo(sgrid, inv(revaff1i))[None,...,[2,1,0]], device=device, dtype=torch.float32)
-        del sgrid
-
-        dnat = np.asarray(F.grid_sample(torch.as_tensor(output, dtype=torch.float32, device=device)[None,None], wgridt, align_corners=True).cpu())[0,0]
-        #nibabel.Nifti1Image(dnat, img.affine).to_filename(outfilename.replace("_tiv", "_tissues%d" % 0))
-        nibabel.Nifti1Image((dnat > .5).astype("uint8"), img.affine).to_filename(outfilename.replace("_tiv", "_brain_mask"))
-        vol = (dnat > .5).sum() * np.abs(np.linalg.det(img.affine))
-        print(" Estimated intra-cranial volume (mm^3) (native space): %d" % vol)
+    return d, warnings
+
+class LoadedImage(object):
+    " an opened image with its data already read by load_volume(), which process() accepts as src "
+    def __init__(self, img):
+        self.img = img
+        self.data, self.warnings = load_volume(img)
+
+def mask_box(res):
+    " the slices of the native image covered by the hippocampus masks of a process() result "
+    return tuple(slice(o, o + n) for o, n in zip(res["mask_offset"], res["mask_L"].shape))
+
+def full_mask(res, side):
+    " the hippocampus mask of side 'L' or 'R' of a process() result, in the whole native image "
+    full = np.zeros(res["img"].shape[:3], np.uint8)
+    full[mask_box(res)] = res["mask_" + side]
+    return full
+
+def save_sparse_masks(res, filename, sides="LR"):
+    " save the hippocampus masks of sides as the (i,j,k) voxel indices and values of their non-zero voxels, in a npz "
+    arrays = dict(shape=np.array(res["img"].shape[:3]), affine=res["img"].affine)
+    for side in sides:
+        mask = res["mask_" + side]
+        ijk = np.nonzero(mask)
+        arrays[side + "_ijk"] = (np.transpose(ijk) + res["mask_offset"]).astype(np.uint16)
+        arrays[side + "_value"] = mask[ijk]
+    np.savez_compressed(filename, **arrays)
+
+def label_map(res, sides="LR"):
+    " the brain and hippocampus (of sides) masks of a process() result as a single label image: 0 background, 1 left, 2 right hippocampus, 3 brain "
+    labels = np.zeros(res["img"].shape[:3], np.uint8)
+    if res["brain_mask"] is not None:
+        labels[res["brain_mask"] > 0] = 3
+    if sides:
+        box = labels[mask_box(res)]
+        for label, side in enumerate("LR", 1):
+            if side in sides:
+                box[res["mask_" + side] >= 128] = label
+    return labels
+
+MASK_FORMATS = ["full", "crop", "sparse", "labels"]
+
+def mask_filenames(outfilename, mask_format="full", compress=True, outputs=DEFAULT_OUTPUTS):
+    " the mask files of outputs written by HippoDeepPipeline.save(), by output name; outfilename is the '*_tiv.nii.gz' name "
+    base = outfilename.replace("_tiv.nii.gz", "")
+    ext = ".nii.gz" if compress else ".nii"
+    hippo = [side for side in ["mask_L", "mask_R"] if side in outputs]
+    if mask_format == "labels":
+        return dict(labels=base + "_labels" + ext) if hippo or "brain_mask" in outputs else {}
+    fnames = {}
+    if "brain_mask" in outputs:
+        fnames["brain_mask"] = base + "_brain_mask" + ext
+    if mask_format == "sparse":
+        if hippo:
+            fnames["masks"] = base + "_masks_LR.npz"
+    else:
+        for side in hippo:
+            fnames[side] = base + "_" + side + ext
+    return fnames
+
+
+# network weights
+params_head = os.path.normpath(scriptpath + "/torchparams/params_head_00075_00000.pt")
+params_affine = os.path.normpath(scriptpath + "/torchparams/paramsaffineta_00079_00000.pt")
+params_hippo = os.path.normpath(scriptpath + "/torchparams/hippodeep.pt")
+
+
+class HippoDeepPipeline(object):
+    """
+    The head, MNI-affine and hippocampus networks, with weights loaded once.
+    process() can then be called on any number of subjects from the same
+    (warm) process; save() and report() write its results to disk.
+    With a ResultCache, images already processed are not segmented again;
+    refresh recomputes (and re-caches) them anyway.
+    With a StageProfiler, the time and memory of each stage is recorded in
+    the "profile" of the results.
+    mask_format is how save() writes the hippocampus masks: "full" NIfTIs of
+    the size of the input, NIfTIs "crop"ped to the hippocampus box (with the
+    matching affine), a "sparse" npz of the non-zero voxels, or a single
+    "labels" map also holding the brain mask.
+    The NIfTIs are gzipped at gzip_level with gzip_threads, or written as
+    (uncompressed) .nii without compress.
+    With frozen, the networks exported by hippodeep_export.py are used when
+    there are some for the current weights.
+    precision "bf16" or "int8" runs the head and hippo networks in reduced
+    precision (see hippodeep_precision.py), "fp32" as they were trained.
+    backend "onnx" runs the three networks with ONNX Runtime (exported by
+    hippodeep_onnx.py), "torch" with torch.
+    outputs are the PRODUCTS to write (DEFAULT_OUTPUTS by default), the
+    optional stages that none of them needs are skipped.
+    The 64^3 sampling grids of each image orientation are kept for the next
+    subjects, and the native-space ones in a cache of geometry_cache_mb
+    (none by default, see hippodeep_geometry.py).
+    """
+    def __init__(self, device="cpu", verbose=True, cache=None, refresh=False, profiler=None, mask_format="full",
+                 compress=True, gzip_level=1, gzip_threads=1, frozen=True, precision="fp32",
+                 backend="torch", geometry_cache_mb=0, outputs=None):
+        self.device = device = torch.device(device)
+        self.verbose = verbose
+        self.cache = cache
+        self.refresh = refresh
+        self.profiler = profiler
+        self.mask_format = mask_format
+        self.compress = compress
+        self.gzip_level = gzip_level
+        self.gzip_threads = gzip_threads
+        self.precision = precision
+        self.backend = backend
+        self.outputs = set(DEFAULT_OUTPUTS if outputs is None else outputs) | set(["volumes"])
+        if self.outputs - set(PRODUCTS):
+            raise ValueError("unknown outputs %s (%s)" % (", ".join(sorted(self.outputs - set(PRODUCTS))), ", ".join(PRODUCTS)))
+        self.needed = required(self.outputs)
+        self.geometry = GeometryCache(geometry_cache_mb << 20)
+        self.geometry64 = GeometryCache(16 << 20) # 3 MB per orientation
+
+        self.grid64 = ModelAff().grid.to(device) # the 64^3 sampling grid of the head networks
+
+        if backend == "onnx":
+            if precision != "fp32" or device.type != "cpu":
+                raise ValueError("the onnx backend runs in fp32 on the CPU only")
+            self.frozen = False
+            self.net, self.netAff, self.hipponet = load_onnx([params_head, params_affine, params_hippo], torch.get_num_threads())
+            return
+        elif backend != "torch":
+            raise ValueError("unknown backend %r (%s)" % (backend, ", ".join(BACKENDS)))
+
+        # the reduced precisions are made from the eager networks
+        nets = frozen and precision == "fp32" and load_frozen([params_head, params_affine, params_hippo], device)
+        self.frozen = bool(nets)
+        if nets:
+            self.net, self.netAff, self.hipponet = nets
+            return
+
+        self.net = HeadModel()
+        self.net.to(device)
+        self.net.load_state_dict(torch.load(params_head, map_location=device))
+        self.net.eval()
+
+        self.netAff = ModelAff()
+        self.netAff.load_state_dict(torch.load(params_affine, map_location=device), strict=False)
+        self.netAff.to(device)
+        self.netAff.eval()
+
+        self.hipponet = HippoModel()
+        self.hipponet.load_state_dict(torch.load(params_hippo, map_location=device))
+        self.hipponet.to(device)
+        self.hipponet.eval()
+
+        reduced_precision(self, precision, [params_head, params_affine, params_hippo])
+
+    def log(self, *args):
+        if self.verbose:
+            print(*args)
+
+    def _new_profile(self):
+        if self.profiler is None:
+            return None
+        profile = self.profiler.new()
+        profile["threads"] = torch.get_num_threads()
+        return profile
+
+    def _stage(self, name, *subjects):
+        " profile the enclosed block as stage `name` of the subjects (dicts holding their 'profile') "
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.stage([s["profile"] for s in subjects], name)
+
+    def process(self, src, affine=None, outfilename=None):
+        """
+        Segment one T1 image: src is a filename, a nibabel image, a
+        LoadedImage (already read) or a 3D/4D array (then, affine is its
+        voxel-to-world matrix).
+        Returns a dict with the volumes (eTIV, hippoL, hippoR, in mm^3), the
+        native-space uint8 brain mask, the uint8 hippocampus masks within
+        their bounding box (mask_L, mask_R, the box starting at the voxel
+        mask_offset, see full_mask()) and the native-to-MNI matrix M.
+        outfilename ("*_tiv.nii.gz") is only used for the RES64/DEBUG outputs.
+        """
+        return self.process_batch([src], [affine], [outfilename])[0]
+
+    def process_batch(self, srcs, affines=None, outfilenames=None):
+        """
+        Segment several images at once: their L and (flipped) R hippocampus
+        crops go through HippoModel as a single batch of 2*len(srcs), which
+        makes a better use of the CPU convolution kernels than batches of 2.
+        HeadModel and ModelAff still run one subject at a time, as the oneDNN
+        kernels picked for their layer shapes round differently depending on the
+        batch size, while the results must not depend on --batch-size.
+        Returns the list of process() results.
+        """
+        srcs = list(srcs)
+        affines = list(affines or [None] * len(srcs))
+        outfilenames = outfilenames or [None] * len(srcs)
+        results = [None] * len(srcs)
+        keys = [None] * len(srcs)
+        loaded = [None] * len(srcs)
+        profiled = [dict(profile=self._new_profile()) for src in srcs]
+        todo = []
+        for i, src in enumerate(srcs):
+            with self._stage("load", profiled[i]):
+                loaded[i] = self._load(src, affines[i])
+            if self.cache is not None and not (self.outputs - SAVED_PRODUCTS):
+                img, data, warnings = loaded[i]
+                with self._stage("cache", profiled[i]):
+                    keys[i] = self.cache.key(data, img.affine)
+                    entry = None if self.refresh else self.cache.get(keys[i])
+                    if entry is not None:
+                        results[i] = self._from_cache(loaded[i], entry)
+                        results[i]["profile"] = profiled[i]["profile"]
+                if entry is not None:
+                    continue
+            todo.append(i)
+        if not todo:
+            return results
+
+        subjects = [self._prepare(loaded[i], outfilenames[i], profiled[i]["profile"]) for i in todo]
+
+        d_in = []
+        for s in subjects:
+            with self._stage("head", s), torch.no_grad():
+                out1t = self.net(s["d_orr"])
+            affin = self._head_priors(s, out1t)
+            with self._stage("affine", s), torch.no_grad():
+                wc1, tA = self.netAff(affin)
+            with self._stage("hippo_crop", s):
+                d_in.append(self._hippo_crop(s, wc1, tA[0]))
+
+        # one batch for all the subjects, so each is given the time of the whole batch
+        with self._stage("hippo", *subjects), torch.no_grad():
+            hippoRL = self.hipponet(torch.cat(d_in))
+            hippoRL = np.asarray(hippoRL.cpu())
+
+        for n, (i, s) in enumerate(zip(todo, subjects)):
+            with self._stage("backproject", s):
+                results[i] = self._backproject(s, hippoRL[2*n:2*n+2])
+            if keys[i] is not None:
+                with self._stage("cache", s):
+                    self.cache.put(keys[i], results[i])
+            if s["profile"] is not None:
+                s["profile"]["batch"] = len(todo)
+        return results
+
+    def _open(self, src, affine):
+        if isinstance(src, str):
+            return nibabel.load(src)
+        elif isinstance(src, np.ndarray):
+            return nibabel.Nifti1Image(src, np.identity(4) if affine is None else affine)
+        return src
+
+    def _load(self, src, affine):
+        " the opened image, its data (averaged if 4D) and the warnings for the subject "
+        if isinstance(src, LoadedImage):
+            img, d, warnings = src.img, src.data, src.warnings
+        else:
+            img = self._open(src, affine)
+            d, warnings = load_volume(img)
+        for w in warnings:
+            self.log("Warning: this looks like a timeserie. Averaging it")
+        return img, d, warnings
+
+    def _from_cache(self, loaded, entry):
+        " a process() result from a cache entry "
+        img, d_orig, warnings = loaded
+        self.log(" Using cached results")
+        if entry["eTIV_native"] is not None:
+            self.log(" Estimated intra-cranial volume (mm^3) (native space): %d" % entry["eTIV_native"])
+        self.log(" Hippocampal volumes (L,R)", entry["hippoL"], entry["hippoR"])
+        return dict(img=img, data=d_orig, trn=ornt_to_las(img.affine)[0], M=entry["M"],
+                    eTIV=entry["eTIV"], eTIV_native=entry["eTIV_native"],
+                    hippoL=entry["hippoL"], hippoR=entry["hippoR"],
+                    brain_mask=entry["brain_mask"], mask_L=entry["mask_L"], mask_R=entry["mask_R"], mask_offset=entry["mask_offset"],
+                    scalars=[], warnings=warnings, cached=True)
+
+    # Stages of process_batch(), for one subject whose state is kept in the dict s
+
+    def _prepare(self, loaded, outfilename, profile=None):
+        " normalize the (loaded) image, and resample it to the 64^3 head-model input "
+        device = self.device
+        s = dict(outfilename=outfilename, profile=profile, scalar_output=[], scalar_output_report=[])
+        img, d, warnings = loaded
+
+        with self._stage("normalise", s):
+            # the image is normalized while resampled, see grid_sample_normalized()
+            d_orig = d
+            norm = volume_stats(d)
+
+        with self._stage("resample64", s):
+            trn, trn_back = ornt_to_las(img.affine)
+
+            revaff1 = nibabel.orientations.inv_ornt_aff(trn, (1,1,1)) # mult on o1 to obtain o2
+            revaff1i = nibabel.orientations.inv_ornt_aff(trn_back, (1,1,1)) # mult on o2 to obtain o1
+
+            aff_orig64 = np.linalg.lstsq(bbox_world(np.identity(4), (64,64,64)), bbox_world(img.affine, img.shape[:3]), rcond=None)[0].T
+            voxscale_native64 = np.abs(np.linalg.det(aff_orig64))
+            revaff64i = nibabel.orientations.inv_ornt_aff(trn_back, (64,64,64))
+            aff_reor64 = np.linalg.lstsq(bbox_world(revaff64i, (64,64,64)), bbox_world(img.affine, img.shape[:3]), rcond=None)[0].T
+
+            wgridt = self.geometry64.get(("grid64", revaff1i.tobytes()),
+                lambda: (self.grid64 @ torch.tensor(revaff1i, device=device, dtype=torch.float32))[None,...,[2,1,0]])
+            d_orr = grid_sample_normalized(d, wgridt, *norm)
+
+        if "orig_b64" in self.outputs and outfilename:
+            nibabel.Nifti1Image(np.asarray(d_orr[0,0].cpu()), aff_reor64).to_filename(outfilename.replace("_tiv", "_orig_b64"))
+
+        s.update(img=img, warnings=warnings, norm=norm, d_orig=d_orig, d_orr=d_orr,
+                 trn=trn, revaff1=revaff1, revaff1i=revaff1i, voxscale_native64=voxscale_native64, aff_reor64=aff_reor64)
+        return s
+
+    def _native_grids(self, shape, revaff1i):
+        " native_grids() of an image shape and orientation, from the geometry cache if they fit in it "
+        if not self.geometry.fits(int(np.prod(shape)) * 3 * 4):
+            return None
+        return self.geometry.get(("native", tuple(shape), revaff1i.tobytes()),
+                                 lambda: list(native_grids(shape, revaff1i, self.device)))
+
+    def _head_priors(self, s, out1t):
+        """
+        eTIV from the HeadModel output (brain, cortex, cerebrum priors), and
+        the products of the priors in self.outputs, each computed only when
+        needed; returns the ModelAff input
+        """
+        device, outputs, needed = self.device, self.outputs, self.needed
+        img, outfilename, aff_reor64, revaff1i = s["img"], s["outfilename"], s["aff_reor64"], s["revaff1i"]
+        voxscale_native64 = s["voxscale_native64"]
+        scalar_output, scalar_output_report = s["scalar_output"], s["scalar_output_report"]
+        out1 = np.asarray(out1t[0].cpu())
+
+        # brain mask
+        brain = out1[0]
+        vol = brain[brain > .5].sum() * voxscale_native64
+        if "etiv_txt" in outputs and outfilename:
+            self.log(" Estimated intra-cranial volume (mm^3): %d" % vol)
+            open(outfilename.replace("_tiv.nii.gz", "_eTIV.txt"), "w").write("%d\n" % vol)
         scalar_output.append(vol)
-        brainmask = (dnat > .5).astype("uint8")
-        del dnat
-
-    if 0:
-        # cerebrum mask
-        output = out1[0,2].astype("float32")
-    
-        out_cc, lab = scipy.ndimage.label(output > .01)
-        output *= (out_cc == np.bincount(out_cc.flat)[1:].argmax()+1)
-    
-        vol = (output[output > .5]).sum() * voxscale_native64
-        if OUTPUT_DEBUG:
-            print(" Estimated cerebrum volume (mm^3): %d" % vol)
-        if 0:
-            open(outfilename.replace("_tiv.nii.gz", "_eTIV_nocerebellum.txt"), "w").write("%d\n" % vol)
-        scalar_output.append(vol)
-    
-        if OUTPUT_RES64:
-            out = (output.clip(0, 1) * 255).astype("uint8")
-            nibabel.Nifti1Image(out, aff_reor64, img.header).to_filename(outfilename.replace("_tiv", "_tissues%d_b64" % 2))
-        if OUTPUT_NATIVE:
-            dnat = np.asarray(F.grid_sample(torch.as_tensor(output, dtype=torch.float32, device=device)[None,None], wgridt, align_corners=True).cpu()[0,0])
-            #nibabel.Nifti1Image(dnat, img.affine).to_filename(outfilename.replace("_tiv", "_tissues%d" % 2))
-            nibabel.Nifti1Image((dnat > .5).astype("uint8"), img.affine).to_filename(outfilename.replace("_tiv", "_cerebrum_mask"))
+        scalar_output_report.append(vol)
+
+        s["brainmask"] = None
+        s["vol_native"] = None
+        if "brainmask_native" in needed:
+          with self._stage("brainmask_native", s):
+            # resampled by slabs, as a grid of the whole native image would be several GB for high-res images
+            s["brainmask"] = brainmask = np.empty(img.shape[:3], np.uint8)
+            for x0, x1, dnat in native_slabs(brain, img.shape[:3], revaff1i, device, grids=self._native_grids(img.shape[:3], revaff1i)):
+                np.greater(dnat, .5, out=brainmask[x0:x1], casting="unsafe")
+            s["vol_native"] = vol = brainmask.sum() * np.abs(np.linalg.det(img.affine))
+            self.log(" Estimated intra-cranial volume (mm^3) (native space): %d" % vol)
+            scalar_output.append(vol)
+
+        priors = {0: brain}
+        if "cerebrum_native" in needed:
+            # the largest connected component of the cerebrum prior
+            import scipy.ndimage
+            cerebrum = out1[2]
+            out_cc, lab = scipy.ndimage.label(cerebrum > .01)
+            priors[2] = cerebrum = cerebrum * (out_cc == np.bincount(out_cc.flat)[1:].argmax()+1)
+            vol = cerebrum[cerebrum > .5].sum() * voxscale_native64
+            self.log(" Estimated cerebrum volume (mm^3): %d" % vol)
+            scalar_output.append(vol)
+            dnat = native_resample(cerebrum, img.shape[:3], revaff1i, device, self._native_grids(img.shape[:3], revaff1i))
+            if "cerebrum_mask" in outputs and outfilename:
+                nibabel.Nifti1Image((dnat > .5).astype("uint8"), img.affine).to_filename(outfilename.replace("_tiv", "_cerebrum_mask"))
             vol = (dnat > .5).sum() * np.abs(np.linalg.det(img.affine))
-            print(" Estimated cerebrum volume (mm^3) (native space): %d" % vol)
+            self.log(" Estimated cerebrum volume (mm^3) (native space): %d" % vol)
             scalar_output.append(vol)
             del dnat
 
-    # cortex
-    output = out1[0,1].astype("float32")
-    output[output < .01] = 0
-    if OUTPUT_RES64:
-        out = (output.clip(0, 1) * 255).astype("uint8")
-        nibabel.Nifti1Image(out, aff_reor64, img.header).to_filename(outfilename.replace("_tiv", "_tissues%d_b64" % 1))
-    if OUTPUT_NATIVE and OUTPUT_DEBUG:
-        dnat = np.asarray(F.grid_sample(torch.as_tensor(output, dtype=torch.float32, device=device)[None,None], wgridt, align_corners=True).cpu()[0,0])
-        nibabel.Nifti1Image(dnat, img.affine).to_filename(outfilename.replace("_tiv", "_tissues%d" % 1))
-        del dnat
-
-
-## MNI affine
-    T = time.time()
-    with torch.no_grad():
-        wc1, tA = netAff(out1t[:,[1,3]] * brainmask_cc)
-
-    wnat = np.linalg.lstsq(bbox_world(img.affine, img.shape[:3]), bbox_one @ revaff1, rcond=None)[0]
-    wmni = np.linalg.lstsq(bbox_world(affine64_mni, (64,64,64)), bbox_one, rcond=None)[0]
-    M = (wnat @ inv(np.asarray(tA[0].cpu())) @ inv(wmni)).T
-    # [native world coord] @ M.T -> [mni world coord] , in LAS space
-
-    if OUTPUT_DEBUG:
-        # Output MNI, mostly for debug, save in box64, uint8
-        out2 = np.asarray(wc1.to("cpu"))
-        out2 = np.clip((out2 * 255), 0, 255).astype("uint8")
-        nibabel.Nifti1Image(out2[0,0], affine64_mni).to_filename(outfilename.replace("_tiv", "_mniwrapc1"))
-        del out2
-    if 0:
-        out2r = np.asarray(netAff.resample_other(d_orr).cpu())
-        out2r = (out2r - out2r.min()) * 255 / out2r.ptp()
-        nibabel.Nifti1Image(out2r[0,0].astype("uint8"), affine64_mni).to_filename(outfilename.replace("_tiv", "_mniwrap"))
-        del out2r
-
-
-    # output an ANTs-compatible matrix (AntsApplyTransforms -t)
-    f3 = np.array([[1, 1, -1, -1],[1, 1, -1, -1], [-1, -1, 1, 1], [1, 1, 1, 1]]) # ANTs LPS
-    MI = inv(M) * f3
-    txt = """#Insight Transform File V1.0\nTransform: AffineTransform_float_3_3\nFixedParameters: 0 0 0\nParameters: """
-    txt += " ".join(["%4.6f %4.6f %4.6f" % tuple(x) for x in MI[:3,:3].tolist()]) + " %4.6f %4.6f %4.6f\n" % (MI[0,3], MI[1,3], MI[2,3])
-    if 0:
-        open(outfilename.replace("_tiv.nii.gz", "_mni0Affine.txt"), "w").write(txt)
-
-    u, s, vt = np.linalg.svd(MI[:3,:3])
-    MI3rigid = u @ vt
-    txt = """#Insight Transform File V1.0\nTransform: AffineTransform_float_3_3\nFixedParameters: 0 0 0\nParameters: """
-    txt += " ".join(["%4.6f %4.6f %4.6f" % tuple(x) for x in MI3rigid.tolist()]) + " %4.6f %4.6f %4.6f\n" % (MI[0,3], MI[1,3], MI[2,3])
-    if 0:
-        open(outfilename.replace("_tiv.nii.gz", "_mni0Rigid.txt"), "w").write(txt)
-
-## Hippodeep
-    T = time.time()
-
-    imgcroproi_affine = np.array([[ -1., -0., 0., 54.], [ -0., 1., -0., -59.], [0., 0., 1., -45.], [0., 0., 0., 1.]])
-    imgcroproi_shape = (107, 72, 68)
-    # coord in mm bbox
-    gsx, gsy, gsz = 107, 72, 68
-    sgrid = np.rollaxis(indices_unitary((gsx,gsy,gsz), dtype=np.float32),0,4)
-
-    bboxnat = bbox_world(imgcroproi_affine, imgcroproi_shape) @ inv(M.T) @ wnat
-    matzoom = np.linalg.lstsq(bbox_one, bboxnat, rcond=None)[0] # in -1..1 space
-    # wgridt for hippo box
-    wgridt = torch.tensor(mul_homo( sgrid, (matzoom @ revaff1i) )[None,...,[2,1,0]], device=device, dtype=torch.float32)
-    del sgrid
-    dout = F.grid_sample(torch.as_tensor(d, dtype=torch.float32, device=device)[None,None], wgridt, align_corners=True)
-    # note: d was normalized from full-image
-    d_in = np.asarray(dout[0,0].cpu()) # back to numpy since torch does not support negative step/strides
-
-    if OUTPUT_RES64:
-        d_in_u8 = (((d_in - d_in.min()) / d_in.ptp()) * 255).astype("uint8")
-        nibabel.Nifti1Image(d_in_u8, imgcroproi_affine).to_filename(outfilename.replace("_tiv", "_affcrop"))
-
-    d_in -= d_in.mean()
-    d_in /= d_in.std()
-    # split Left and Right (flipping Right)
-    d_in = np.vstack([d_in[None, None, 6: 54:+1,: ,2:-2 ], d_in[None, None,-7:-55:-1,: ,2:-2 ]])
-
-    d_in = torch.as_tensor(d_in.copy())
-    T = time.time()
-    with torch.no_grad():
-        hippoRL = hipponet(d_in)
-    hippoRL = np.asarray(hippoRL.cpu())
-    #print("Hippo Inferrence in " + str(time.time() - T))
-
-    # smoothly rescale (.5 ~ .75) to (.5 ~ 1.)
-    hippoRL = np.clip(((hippoRL - .5) * 2 + .5), 0, 1) * (hippoRL > .5)
-    # lots numpy/torch copy below, because torch raises errors on negative strides
-    output = np.zeros((2, 107, 72, 68), np.float32)
-    output[0, -7:-55:-1,: ,2:-2][2:-2,2:-2,2:-2] = np.clip(hippoRL[1] * 255, 0, 255)#* maskL
-    output[1, 6: 54:+1,: ,2:-2][2:-2,2:-2,2:-2] = np.clip(hippoRL[0] * 255, 0, 255) # * maskR
-
-    if OUTPUT_DEBUG:
-        #outputfn = outfilename.replace(".nii.gz", "_outseg_L.nii.gz")
-        #nibabel.Nifti1Image(output[0], imgcroproi_affine).to_filename(outputfn)
-        #outputfn = outfilename.replace(".nii.gz", "_outseg_R.nii.gz")
-        #nibabel.Nifti1Image(output[1], imgcroproi_affine).to_filename(outputfn)
-        outputfn = outfilename.replace("_tiv", "_affcrop_outseg_mask")
-        nibabel.Nifti1Image(output.sum(0), imgcroproi_affine).to_filename(outputfn)
-
-    boxvols = hippoRL[[1,0]].reshape(2, -1).sum(1) * np.abs(np.linalg.det(imgcroproi_affine @ inv(M)))
-    scalar_output.append(boxvols)
-
-    if 1:
-        mul_homo = lambda g, Mt : g @ Mt[:3,:3].astype(np.float32) + Mt[3,:3].astype(np.float32)
-
-        def bbox_xyz(shape, affine):
-            " returns the worldspace of the edge of the image "
-            s = shape[0]-1, shape[1]-1, shape[2]-1
-            bbox = [[0,0,0], [s[0],0,0], [0,s[1],0], [0,0,s[2]], [s[0],s[1],0], [s[0],0,s[2]], [0,s[1],s[2]], [s[0],s[1],s[2]]]
-            return mul_homo(bbox, affine.T)
-
-        def indices_xyz(shape, affine, offset_vox= np.array([0,0,0])):
-            assert (len(shape) == 3)
-            ind = np.indices(shape).astype(np.float32) + offset_vox.reshape(3, 1,1,1).astype(np.float32)
-            return mul_homo(np.rollaxis(ind, 0, 4), affine.T)
-
-        def xyz_to_DHW3(xyz, iaffine, srcshape):
-            affine = np.linalg.inv(iaffine)
-            ijk3 = mul_homo(xyz, affine.T)
-            ijk3[...,0] /= srcshape[0] -1
-            ijk3[...,1] /= srcshape[1] -1
-            ijk3[...,2] /= srcshape[2] -1
-            ijk3 = ijk3 * 2 - 1
-            DHW3 = np.swapaxes(ijk3, 0, 2)
-            return DHW3
-
-        pts = bbox_xyz(imgcroproi_shape, imgcroproi_affine)
-        pts = mul_homo(pts, np.linalg.inv(M).T)
-        pts_ijk = mul_homo(pts, np.linalg.inv(img.affine).T)
-        for i in range(3):
-            np.clip(pts_ijk[:,i], 0, img.shape[i], out = pts_ijk[:,i])
-        pmin = np.floor(np.min(pts_ijk, 0)).astype(int)
-        pwidth = np.ceil(np.max(pts_ijk, 0)).astype(int) - pmin
+        if ("cortex" in outputs or "tissues64" in outputs) and outfilename:
+            priors[1] = cortex = np.where(out1[1] < .01, np.float32(0), out1[1])
+            if "cortex" in outputs:
+                dnat = native_resample(cortex, img.shape[:3], revaff1i, device, self._native_grids(img.shape[:3], revaff1i))
+                nibabel.Nifti1Image(dnat, img.affine).to_filename(outfilename.replace("_tiv", "_tissues%d" % 1))
+                del dnat
+
+        if "tissues64" in outputs and outfilename:
+            for c, prior in sorted(priors.items()):
+                out = (prior.clip(0, 1) * 255).astype("uint8")
+                nibabel.Nifti1Image(out, aff_reor64, img.header).to_filename(outfilename.replace("_tiv", "_tissues%d_b64" % c))
+
+        # priors 1 and 3, masked by the brain prior
+        return out1t[:,[1,3]] * out1t[:,:1]
+
+    def _hippo_crop(self, s, wc1, tA):
+        " native-to-MNI matrix from the ModelAff output, and the (normalized) L/R hippocampus crops "
+        device = self.device
+        img, outfilename, d, revaff1, revaff1i = s["img"], s["outfilename"], s["d_orig"], s["revaff1"], s["revaff1i"]
+
+        wnat = np.linalg.lstsq(bbox_world(img.affine, img.shape[:3]), bbox_one @ revaff1, rcond=None)[0]
+        M = (wnat @ inv(np.asarray(tA.cpu())) @ inv(mni_box_matrix())).T
+        # [native world coord] @ M.T -> [mni world coord] , in LAS space
+        s["M"] = M
+
+        outputs = self.outputs if outfilename else set()
+        if "mniwrapc1" in outputs:
+            # Output MNI, mostly for debug, save in box64, uint8
+            out2 = np.asarray(wc1.to("cpu"))
+            out2 = np.clip((out2 * 255), 0, 255).astype("uint8")
+            nibabel.Nifti1Image(out2[0,0], affine64_mni).to_filename(outfilename.replace("_tiv", "_mniwrapc1"))
+            del out2
+        if "mniwrap" in outputs:
+            # as ModelAff.resample_other(), which the frozen and ONNX networks don't have
+            with torch.no_grad():
+                wgrid = self.grid64 @ tA[None,None,None]
+                out2r = np.asarray(F.grid_sample(s["d_orr"], wgrid[...,[2,1,0]], align_corners=True).cpu())
+            out2r = (out2r - out2r.min()) * 255 / np.ptp(out2r)
+            nibabel.Nifti1Image(out2r[0,0].astype("uint8"), affine64_mni).to_filename(outfilename.replace("_tiv", "_mniwrap"))
+            del out2r
+
+        # output an ANTs-compatible matrix (AntsApplyTransforms -t)
+        f3 = np.array([[1, 1, -1, -1],[1, 1, -1, -1], [-1, -1, 1, 1], [1, 1, 1, 1]]) # ANTs LPS
+        MI = inv(M) * f3
+        if "ants_affine" in outputs:
+            txt = """#Insight Transform File V1.0\nTransform: AffineTransform_float_3_3\nFixedParameters: 0 0 0\nParameters: """
+            txt += " ".join(["%4.6f %4.6f %4.6f" % tuple(x) for x in MI[:3,:3].tolist()]) + " %4.6f %4.6f %4.6f\n" % (MI[0,3], MI[1,3], MI[2,3])
+            open(outfilename.replace("_tiv.nii.gz", "_mni0Affine.txt"), "w").write(txt)
+
+        if "ants_rigid" in outputs:
+            u, _, vt = np.linalg.svd(MI[:3,:3])
+            MI3rigid = u @ vt
+            txt = """#Insight Transform File V1.0\nTransform: AffineTransform_float_3_3\nFixedParameters: 0 0 0\nParameters: """
+            txt += " ".join(["%4.6f %4.6f %4.6f" % tuple(x) for x in MI3rigid.tolist()]) + " %4.6f %4.6f %4.6f\n" % (MI[0,3], MI[1,3], MI[2,3])
+            open(outfilename.replace("_tiv.nii.gz", "_mni0Rigid.txt"), "w").write(txt)
+
+        # coord in mm bbox
+        sgrid = hippo_crop_grid()
+
+        bboxnat = bbox_world(imgcroproi_affine, imgcroproi_shape) @ inv(M.T) @ wnat
+        matzoom = np.linalg.lstsq(bbox_one, bboxnat, rcond=None)[0] # in -1..1 space
+        # wgridt for hippo box
+        wgridt = torch.tensor(mul_homo( sgrid, (matzoom @ revaff1i) )[None,...,[2,1,0]], device=device, dtype=torch.float32)
+        dout = grid_sample_normalized(d, wgridt, *s["norm"])
+        # note: d was normalized from full-image
+        d_in = np.asarray(dout[0,0].cpu()) # back to numpy since torch does not support negative step/strides
+
+        if "affcrop" in outputs:
+            d_in_u8 = (((d_in - d_in.min()) / np.ptp(d_in)) * 255).astype("uint8")
+            nibabel.Nifti1Image(d_in_u8, imgcroproi_affine).to_filename(outfilename.replace("_tiv", "_affcrop"))
+
+        d_in -= d_in.mean()
+        d_in /= d_in.std()
+        # split Left and Right (flipping Right)
+        d_in = np.vstack([d_in[None, None, 6: 54:+1,: ,2:-2 ], d_in[None, None,-7:-55:-1,: ,2:-2 ]])
+
+        return torch.as_tensor(d_in.copy(), device=device)
+
+    def _backproject(self, s, hippoRL):
+        " hippocampal volumes and native-space masks from the HippoModel output (L, flipped R) "
+        img, outfilename, M = s["img"], s["outfilename"], s["M"]
+        scalar_output, scalar_output_report = s["scalar_output"], s["scalar_output_report"]
+
+        # smoothly rescale (.5 ~ .75) to (.5 ~ 1.)
+        hippoRL = np.clip(((hippoRL - .5) * 2 + .5), 0, 1) * (hippoRL > .5)
+        # lots numpy/torch copy below, because torch raises errors on negative strides
+        output = np.zeros((2, 107, 72, 68), np.float32)
+        output[0, -7:-55:-1,: ,2:-2][2:-2,2:-2,2:-2] = np.clip(hippoRL[1] * 255, 0, 255)#* maskL
+        output[1, 6: 54:+1,: ,2:-2][2:-2,2:-2,2:-2] = np.clip(hippoRL[0] * 255, 0, 255) # * maskR
+
+        if "affcrop_seg" in self.outputs and outfilename:
+            outputfn = outfilename.replace("_tiv", "_affcrop_outseg_mask")
+            nibabel.Nifti1Image(output.sum(0), imgcroproi_affine).to_filename(outputfn)
+
+        boxvols = hippoRL[[1,0]].reshape(2, -1).sum(1) * np.abs(np.linalg.det(imgcroproi_affine @ inv(M)))
+        scalar_output.append(boxvols)
+
+        if not self.outputs & MASK_PRODUCTS:
+            # volumes only, without the native-space masks
+            volsAA_L, volsAA_R = crop_volumes(output, M, img)
+            self.log(" Hippocampal volumes (L,R)", volsAA_L, volsAA_R)
+            scalar_output.append([volsAA_L, volsAA_R])
+            scalar_output_report.append([volsAA_L, volsAA_R])
+            return dict(img=img, data=s["d_orig"], trn=s["trn"], M=M,
+                        eTIV=scalar_output_report[0], eTIV_native=s["vol_native"],
+                        hippoL=volsAA_L, hippoR=volsAA_R,
+                        brain_mask=s["brainmask"], mask_L=None, mask_R=None, mask_offset=None,
+                        scalars=scalar_output, warnings=s["warnings"], profile=s["profile"])
+
+        # back-project the crop output into native space, within its bounding box
+        pmin, pwidth = native_box(bbox_xyz(imgcroproi_shape, imgcroproi_affine), M, img)
 
         widx = indices_xyz(pwidth, img.affine, offset_vox=pmin)
-
         widx = mul_homo(widx, M.T)
-
         DHW3 = xyz_to_DHW3(widx, imgcroproi_affine, imgcroproi_shape)
 
-        wdata_L = np.zeros(img.shape[:3], np.uint8)
-        wdata_R = np.zeros(img.shape[:3], np.uint8)
-
-        d = torch.tensor(output[0].T, dtype=torch.float32)
-        outDHW = F.grid_sample(d[None,None], torch.tensor(DHW3[None]), align_corners=True)
-        dnat = np.asarray(outDHW[0,0].T)
-        dnat[dnat < 32] = 0 # remove noise
-        volsAA_L = dnat.sum() / 255. * np.abs(np.linalg.det(img.affine))
-        wdata_L[pmin[0]:pmin[0]+pwidth[0], pmin[1]:pmin[1]+pwidth[1], pmin[2]:pmin[2]+pwidth[2]] = dnat.astype(np.uint8)
-        #nibabel.Nifti1Image(wdata_L.astype("uint8"), img.affine).to_filename(outfilename.replace("_tiv", "_mask_L"))
-        #transcribe parameters from original header
-        img_out = nibabel.Nifti1Image(wdata_L.astype("uint8"), img.affine)
-        unit_xyz, unit_t = img.header.get_xyzt_units()
-        if unit_xyz == 'unknown': unit_xyz=0
-        if unit_t   == 'unknown': unit_t=0        
-        img_out.header.set_xyzt_units(unit_xyz, unit_t)
-        img_out.set_sform(img.affine, code=int(img.header['sform_code']))
-        img_out.set_qform(img.affine, code=int(img.header['qform_code']))
-        nibabel.save(img_out,outfilename.replace("_tiv", "_mask_L"))        
-        
-        d = torch.tensor(output[1].T, dtype=torch.float32)
-        outDHW = F.grid_sample(d[None,None], torch.tensor(DHW3[None]), align_corners=True)
-        dnat = np.asarray(outDHW[0,0].T)
-        dnat[dnat < 32] = 0 # remove noise
-        volsAA_R = dnat.sum() / 255. * np.abs(np.linalg.det(img.affine))
-        wdata_R[pmin[0]:pmin[0]+pwidth[0], pmin[1]:pmin[1]+pwidth[1], pmin[2]:pmin[2]+pwidth[2]] = dnat.astype(np.uint8)
-        #nibabel.Nifti1Image(wdata_R.astype("uint8"), img.affine).to_filename(outfilename.replace("_tiv", "_mask_R"))
-        #transcribe parameters from original header
-        img_out = nibabel.Nifti1Image(wdata_R.astype("uint8"), img.affine)
-        unit_xyz, unit_t = img.header.get_xyzt_units()
-        if unit_xyz == 'unknown': unit_xyz=0
-        if unit_t   == 'unknown': unit_t=0        
-        img_out.header.set_xyzt_units(unit_xyz, unit_t)
-        img_out.set_sform(img.affine, code=int(img.header['sform_code']))
-        img_out.set_qform(img.affine, code=int(img.header['qform_code']))
-        nibabel.save(img_out,outfilename.replace("_tiv", "_mask_R"))  
-
-        print(" Hippocampal volumes (L,R)", volsAA_L, volsAA_R)
+        # both sides at once, as the two channels of a single grid_sample; the masks are kept within the box
+        d = torch.tensor(output.transpose(0, 3, 2, 1), dtype=torch.float32)
+        outDHW = F.grid_sample(d[None], torch.tensor(DHW3[None]), align_corners=True)
+        masks, vols = [], []
+        for side in range(2):
+            dnat = np.asarray(outDHW[0,side].T)
+            dnat[dnat < 32] = 0 # remove noise
+            vols.append(dnat.sum() / 255. * np.abs(np.linalg.det(img.affine)))
+            masks.append(dnat.astype(np.uint8))
+        volsAA_L, volsAA_R = vols
+        wdata_L, wdata_R = masks
+
+        self.log(" Hippocampal volumes (L,R)", volsAA_L, volsAA_R)
         scalar_output.append([volsAA_L, volsAA_R])
         scalar_output_report.append([volsAA_L, volsAA_R])
 
+        return dict(img=img, data=s["d_orig"], trn=s["trn"], M=M,
+                    eTIV=scalar_output_report[0], eTIV_native=s["vol_native"],
+                    hippoL=volsAA_L, hippoR=volsAA_R,
+                    brain_mask=s["brainmask"], mask_L=wdata_L, mask_R=wdata_R, mask_offset=pmin,
+                    scalars=scalar_output, warnings=s["warnings"], profile=s["profile"])
+
+    def save(self, res, outfilename):
+        " write the native-space masks and the volumes csv, returns their filenames; outfilename is the '*_tiv.nii.gz' name "
+        img = res["img"]
+        outputs = mask_filenames(outfilename, self.mask_format, self.compress, self.outputs)
+        gz = dict(level=self.gzip_level, threads=self.gzip_threads)
+        sides = "".join(side for side in "LR" if "mask_" + side in self.outputs)
+        if "labels" in outputs:
+            save_mask(label_map(res, sides), img, outputs["labels"], **gz)
+        if "brain_mask" in outputs and res["brain_mask"] is not None:
+            write_nifti(nibabel.Nifti1Image(res["brain_mask"], img.affine), outputs["brain_mask"], **gz)
+        if "masks" in outputs:
+            save_sparse_masks(res, outputs["masks"], sides)
+        for side in "LR":
+            if "mask_" + side not in outputs:
+                continue
+            if self.mask_format == "crop":
+                save_mask(res["mask_" + side], img, outputs["mask_" + side], offset=res["mask_offset"], **gz)
+            else:
+                save_mask(full_mask(res, side), img, outputs["mask_" + side], **gz)
+
+        if "scalars" in self.outputs:
+            scalar_output = res["scalars"]
+            txt = "eTIV_mni,eTIV,cerebrum_mni,cerebrum,mni_hippoL,mni_hippoR,hippoL,hippoR\n"
+            txt += "%4f,%4f,%4f,%4f,%4.4f,%4.4f,%4.4f,%4.4f\n" % (tuple(scalar_output[:4]) + tuple(scalar_output[4])+ tuple(scalar_output[5]))
+            open(outfilename.replace("_tiv.nii.gz", "_scalars_hippo.csv"), "w").write(txt)
 
-    if OUTPUT_DEBUG:
-        txt = "eTIV_mni,eTIV,cerebrum_mni,cerebrum,mni_hippoL,mni_hippoR,nat_hippoL,nat_hippoR,hippoL,hippoR\n"
-        txt += "%4f,%4f,%4f,%4f,%4.4f,%4.4f,%4.4f,%4.4f,%4.4f,%4.4f\n" % (tuple(scalar_output[:4]) + tuple(scalar_output[4])+ tuple(scalar_output[5])+ tuple(scalar_output[6]))
-        open(outfilename.replace("_tiv.nii.gz", "_scalars_hippo.csv"), "w").write(txt)
-
-    if 1:
         txt = "eTIV,hippoL,hippoR\n"
-        txt += "%4f,%4f,%4f\n" % (scalar_output_report[0], scalar_output_report[1][0], scalar_output_report[1][1])
-        open(outfilename.replace("_tiv.nii.gz", "_hippoLR_volumes.csv"), "w").write(txt)
-
-    if OUTPUT_RES64:
-        print("fslview %s %s -t .5 &" % (outfilename.replace("_tiv", "_affcrop"), outfilename.replace("_tiv", "_affcrop_outseg_mask")))
-
+        txt += "%4f,%4f,%4f\n" % (res["eTIV"], res["hippoL"], res["hippoR"])
+        outputs["volumes"] = outfilename.replace("_tiv.nii.gz", "_hippoLR_volumes.csv")
+        open(outputs["volumes"], "w").write(txt)
+        return outputs
+
+    def report(self, res, outfilename):
+        " generate the PDF report, returns its filename; outfilename is the '*_tiv.nii.gz' name "
+        img, trn = res["img"], res["trn"]
+        vol = res["eTIV"] if res["eTIV_native"] is None else res["eTIV_native"]
+        text0 = "HippoDeep Report"
+        text1="Total Intracranial Volume:  "
+        text2="Left  Hippocampus  Volume:  "
+        text3="Right Hippocampus  Volume:  "
+        text1 += "{:.2f}".format(float(vol)/1000000,2)+" l" # transform mm^3 to liter
+        text2 += "{:.2f}".format(float(res["hippoL"])/1000,2)+" ml" # transform mm^3 to mililiter
+        text3 += "{:.2f}".format(float(res["hippoR"])/1000,2)+" ml" # transform mm^3 to mililiter
+        from HippoDeepReport import HippoDeepReport
+        filename = outfilename.replace("_tiv.nii.gz", ".pdf")
+        # transform 2 std
+        SpatResol = np.asarray(img.header.get_zooms())
+        d_orig    = nibabel.apply_orientation(res["data"], trn )
+        wdata_L   = nibabel.apply_orientation(full_mask(res, "L"), trn )
+        wdata_R   = nibabel.apply_orientation(full_mask(res, "R"), trn )
+        brainmask = nibabel.apply_orientation(res["brain_mask"], trn )
+        SpatResol[int(trn[0,0])],  SpatResol[int(trn[1,0])], SpatResol[int(trn[2,0])] = SpatResol[0],  SpatResol[1], SpatResol[2]
+        # go
+        HippoDeepReport (SpatResol, d_orig, wdata_L, wdata_R, brainmask, text0, text1, text2, text3, filename)
+        return filename
+
+
+def subject_outfilename(fname):
+    " the '*_tiv.nii.gz' name from which all output filenames of a subject are derived "
+    return subject_base(fname) + "_tiv.nii.gz"
+
+def run_subject(pipeline, fname, report=True, img=None, writer=None):
+    """
+    Process one file as the command line does: segment it, then write the
+    masks, volumes csv and PDF report next to it.
+    img is the already opened image (or the exception raised opening it)
+    when prefetched; with an AsyncWriter, the outputs are written in the
+    background.
+    Returns the HippoDeepPipeline.process() result, with the written
+    filenames in res["outputs"] once written, or None if the file can't be opened.
+    """
+    return run_batch(pipeline, [fname], report, [img], writer)[0]
+
+def run_batch(pipeline, fnames, report=True, imgs=None, writer=None):
+    " as run_subject(), for several files segmented together by HippoDeepPipeline.process_batch() "
+    Ti = time.time()
+    imgs = list(imgs or [None] * len(fnames))
+    todo = []
+    for i, fname in enumerate(fnames):
+        try:
+            print("Loading image " + fname)
+            if isinstance(imgs[i], Exception):
+                raise imgs[i]
+            if imgs[i] is None:
+                imgs[i] = nibabel.load(fname)
+
+            img = imgs[i].img if isinstance(imgs[i], LoadedImage) else imgs[i]
+            if img.header["qform_code"] == 0:
+                print(" *** Warning: the header of this nifti file has no qform_code defined.")
+                print(" Fix the header manually or reconvert from the original DICOM.")
+        except:
+            open(fname + ".warning.txt", "a").write("can't open the file\n")
+            print(" *** Error: can't open file. Skip")
+            continue
+        todo.append(i)
+
+    results = [None] * len(fnames)
+    if not todo:
+        return results
+    batch = pipeline.process_batch([imgs[i] for i in todo], outfilenames=[subject_outfilename(fnames[i]) for i in todo])
+    for i, res in zip(todo, batch):
+        for w in res["warnings"]:
+            open(fnames[i] + ".warning.txt", "a").write(w)
+        if writer is None:
+            write_subject(pipeline, fnames[i], res, report, Ti, len(todo))
+        else:
+            writer.submit(write_subject, pipeline, fnames[i], res, report, Ti, len(todo))
+        results[i] = res
+    return results
+
+def write_subject(pipeline, fname, res, report, Ti, batch=1):
+    " write the outputs of a processed subject, then print the end of its log in one block; Ti is the start time of its batch of batch subjects "
+    outfilename = subject_outfilename(fname)
+    with pipeline._stage("write", res):
+        res["outputs"] = pipeline.save(res, outfilename)
+    log = []
+
+    if "affcrop" in pipeline.outputs and "affcrop_seg" in pipeline.outputs:
+        log.append("fslview %s %s -t .5 &" % (outfilename.replace("_tiv", "_affcrop"), outfilename.replace("_tiv", "_affcrop_outseg_mask")))
+
+    if report and "report" in pipeline.outputs:
+        try:
+          with pipeline._stage("report", res):
+            res["outputs"]["report"] = pipeline.report(res, outfilename)
+          log.append(" Generated PDF report")
+        except Exception as e: log.append(" Generating PDF report failed (%s: %s)" % (type(e).__name__, e))
+    if pipeline.profiler is not None:
+        pipeline.profiler.write(fname, res["profile"])
+
+    if batch > 1: # the subjects of a batch are segmented together
+        log.append(" Elapsed time for the batch of %d subjects %4.2fs " % (batch, time.time() - Ti))
+    else:
+        log.append(" Elapsed time for subject %4.2fs " % (time.time() - Ti))
+    masks = [res["outputs"][k] for k in ["mask_L", "mask_R", "labels"] if k in res["outputs"]]
+    if masks:
+        log.append(" To display using fslview, try:")
+        log.append("  fslview %s &" % " ".join([fname] + [m + " -t .5" for m in masks]))
+    print("\n".join(log))
+
+
+def completed_volumes(fname, mask_format="full", compress=True, outputs=DEFAULT_OUTPUTS):
+    """
+    (eTIV, hippoL, hippoR) read from the csv of a subject whose output masks
+    and csv all exist and are newer than its input, otherwise None.
+    """
+    outfilename = subject_outfilename(fname)
+    csvname = outfilename.replace("_tiv.nii.gz", "_hippoLR_volumes.csv")
+    outputs = list(mask_filenames(outfilename, mask_format, compress, outputs).values()) + [csvname]
     try:
-      text0 = "HippoDeep Report"
-      text1="Total Intracranial Volume:  "
-      text2="Left  Hippocampus  Volume:  "
-      text3="Right Hippocampus  Volume:  "
-      text1 += "{:.2f}".format(float(vol)/1000000,2)+" l" # transform mm^3 to liter
-      text2 += "{:.2f}".format(float(volsAA_L)/1000,2)+" ml" # transform mm^3 to mililiter   
-      text3 += "{:.2f}".format(float(volsAA_R)/1000,2)+" ml" # transform mm^3 to mililiter
-      filename = outfilename.replace("_tiv.nii.gz", ".pdf")
-      # transform 2 std
-      SpatResol = np.asarray(img.header.get_zooms())
-      d_orig    = nibabel.apply_orientation(d_orig, trn )
-      wdata_L   = nibabel.apply_orientation(wdata_L, trn )
-      wdata_R   = nibabel.apply_orientation(wdata_R, trn )
-      brainmask = nibabel.apply_orientation(brainmask, trn )
-      SpatResol[int(trn[0,0])],  SpatResol[int(trn[1,0])], SpatResol[int(trn[2,0])] = SpatResol[0],  SpatResol[1], SpatResol[2]
-      # go
-      HippoDeepReport (SpatResol, d_orig, wdata_L, wdata_R, brainmask, text0, text1, text2, text3, filename)
-      print (" Generated PDF report")
-    except: print (" Generating PDF report failed") 
-       
-    print(" Elapsed time for subject %4.2fs " % (time.time() - Ti))
-    print(" To display using fslview, try:")
-    print("  fslview %s %s -t .5 %s -t .5 &" % (fname, outfilename.replace("_tiv", "_mask_L"), outfilename.replace("_tiv", "_mask_R")))
-
-
-    allsubjects_scalar_report.append( (fname, scalar_output_report[0], scalar_output_report[1][0], scalar_output_report[1][1]) )
-
-if 1: #OUTPUT_DEBUG:
-  if sys.platform=="win32":
-    print("Peak memory used (Gb) " + str(round(psutil.Process().memory_info().peak_wset/ (1024.*1024*1024),2)))
-  else:
-    print("Peak memory used (Gb) " + str(round(resource.getrusage(resource.RUSAGE_SELF)[2] / (1024.*1024),2)))
-
-print("Done")
-
-if len(sys.argv[1:]) > 1:
-    outfilename = (os.path.dirname(fname) or ".") + "/all_subjects_hippo_report.csv"
-    txt_entries = ["%s,%4f,%4f,%4f\n" % s for s in allsubjects_scalar_report]
-    open(outfilename, "w").writelines( [ "filename,eTIV,hippoL,hippoR\n" ] + txt_entries)
-    print("Volumes of every subjects saved as " + outfilename)
-
-#pause for windows to be able to see messages
-if sys.platform=="win32": os.system("pause") # windows
-  
\ No newline at end of file
+        t = os.path.getmtime(fname)
+        if any(os.path.getmtime(o) <= t for o in outputs):
+            return None
+        with open(csvname) as f:
+            eTIV, hippoL, hippoR = [float(x) for x in f.read().splitlines()[1].split(",")]
+    except (OSError, ValueError, IndexError):
+        return None
+    return eTIV, hippoL, hippoR
+
+def load_image(fname):
+    " open an image and read its data, as a LoadedImage that process() uses as is "
+    return LoadedImage(nibabel.load(fname))
+
+def prefetch_images(fnames, depth):
+    """
+    Yields (fname, img) for every file, while the next `depth` images are
+    being read and decoded in background threads. img is the exception
+    raised if the file can't be opened.
+    """
+    def load(fname):
+        try: return load_image(fname)
+        except Exception as e: return e
+    fnames = iter(fnames)
+    with ThreadPoolExecutor(depth) as executor:
+        pending = collections.deque((fname, executor.submit(load, fname)) for fname in itertools.islice(fnames, depth))
+        while pending:
+            fname, future = pending.popleft()
+            for nextfname in itertools.islice(fnames, 1):
+                pending.append((nextfname, executor.submit(load, nextfname)))
+            yield fname, future.result()
+
+class AsyncWriter(object):
+    " writes the outputs of subjects in a background thread, with at most `depth` subjects waiting "
+    def __init__(self, depth):
+        self.depth = depth
+        self.pending = collections.deque()
+        self.executor = ThreadPoolExecutor(1)
+
+    def submit(self, fn, *args):
+        while len(self.pending) >= self.depth:
+            self.pending.popleft().result() # also raises any error from writing
+        self.pending.append(self.executor.submit(fn, *args))
+
+    def close(self):
+        while self.pending:
+            self.pending.popleft().result()
+        self.executor.shutdown()
+
+
+# pool workers each hold their own copy of the pipeline
+_worker_pipeline = None
+_worker_report = True
+
+def _init_worker(threads, profile, settings, report=True):
+    global _worker_pipeline, _worker_report
+    torch.set_num_threads(threads)
+    _worker_pipeline = HippoDeepPipeline(profiler=profile and StageProfiler(profile), **settings)
+    _worker_report = report
+
+def _run_worker(fnames):
+    " process a batch of files in a pool worker; returns their report rows (or None) and the log, printed by the parent in order "
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        results = run_batch(_worker_pipeline, fnames, _worker_report)
+    rows = [None if res is None else (fname, res["eTIV"], res["hippoL"], res["hippoR"]) for fname, res in zip(fnames, results)]
+    return rows, log.getvalue()
+
+def chunks(iterable, size):
+    " split into lists of (at most) size items "
+    iterable = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+def peak_memory_gb():
+    if sys.platform=="win32":
+        return psutil.Process().memory_info().peak_wset / (1024.*1024*1024)
+    # the largest of this process and of the (terminated) pool workers
+    return max(resource.getrusage(resource.RUSAGE_SELF)[2], resource.getrusage(resource.RUSAGE_CHILDREN)[2]) / (1024.*1024)
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--no-cache", action="store_true", help="don't use the results cache")
+    parser.add_argument("--refresh", action="store_true", help="recompute (and re-cache) the results of already cached images")
+    parser.add_argument("--cache-dir", help="results cache directory (default: $HIPPODEEP_CACHE or ~/.cache/hippodeep)")
+    parser.add_argument("--cache-size", type=int, default=2048, metavar="MB", help="size cap of the results cache, least recently used entries are evicted (default: 2048)")
+
+def cache_from_args(args):
+    if args.no_cache:
+        return None
+    # the results also depend on the network weights and on the output settings
+    params = [params_head, params_affine, params_hippo]
+    outputs = getattr(args, "outputs", DEFAULT_OUTPUTS)
+    salt = files_digest(params) + " native=%d" % ("brainmask_native" in required(outputs))
+    if not set(outputs) & MASK_PRODUCTS:
+        salt += " volumes" # without the hippocampus masks
+    precision = getattr(args, "precision", "fp32")
+    if getattr(args, "backend", "torch") != "torch":
+        salt += " " + args.backend
+    elif precision != "fp32":
+        salt += " " + precision
+    elif not getattr(args, "no_frozen", False) and frozen_info(params) is not None:
+        salt += " frozen" # which round slightly differently
+    return ResultCache(args.cache_dir, args.cache_size << 20, salt=salt)
+
+def add_pipeline_arguments(parser):
+    " the options of the HippoDeepPipeline settings, and of its results cache "
+    parser.add_argument("--mask-format", choices=MASK_FORMATS, default="full", help="hippocampus masks as NIfTIs of the size of the input (full, default), NIfTIs cropped to the hippocampus box (crop), the non-zero voxels of both in a npz (sparse), or a single label map of the brain and hippocampi (labels: 0 background, 1 left, 2 right, 3 brain)")
+    parser.add_argument("--no-gzip", action="store_true", help="write uncompressed .nii masks")
+    parser.add_argument("--gzip-level", type=int, default=1, choices=range(1, 10), metavar="1-9", help="gzip compression level of the masks (default: 1)")
+    parser.add_argument("--gzip-threads", type=int, default=1, metavar="N", help="compress each mask with N threads, as independent gzip blocks (default: 1)")
+    parser.add_argument("--no-frozen", action="store_true", help="use the eager networks even if frozen ones were exported (by hippodeep_export.py)")
+    parser.add_argument("--precision", choices=PRECISIONS, default="fp32", help="run the head and hippocampus networks in float32 (default), bfloat16 (fast on CPUs with AVX512-BF16/AMX) or int8 (quantized, see hippodeep_precision.py --check for its accuracy)")
+    parser.add_argument("--backend", choices=BACKENDS, default="torch", help="run the networks with torch (default) or ONNX Runtime (onnx, exported by hippodeep_onnx.py --export)")
+    parser.add_argument("--geometry-cache", type=int, default=0, metavar="MB", help="keep the native-space sampling grids of up to MB megabytes for the next subjects of the same image shape and orientation, which saves their computation but adds MB to the peak memory (default: 0, none; a 256^3 image needs 200)")
+    parser.add_argument("--outputs", type=parse_outputs, default=set(DEFAULT_OUTPUTS), metavar="LIST", help="comma separated products to write, 'default' standing for %s (the default); the volumes csv is always written. Products: %s" % (",".join(DEFAULT_OUTPUTS), "; ".join("%s: %s" % p for p in PRODUCTS.items())))
+    parser.add_argument("--volumes-only", action="store_true", help="only write the volumes csv (as --outputs volumes), computing the hippocampal volumes without their native-space masks (identical but for the float32 rounding of the sums, below 1e-3 mm^3)")
+    parser.add_argument("--no-report", action="store_true", help="don't generate the PDF reports (nor import the PDF libraries), as --outputs without report")
+    add_cache_arguments(parser)
+
+def pipeline_settings(args):
+    " the HippoDeepPipeline arguments of the options of add_pipeline_arguments(); sets args.outputs to the products written "
+    if args.volumes_only:
+        args.outputs = set(["volumes"])
+    if args.no_report:
+        args.outputs.discard("report")
+    return dict(cache=cache_from_args(args), refresh=args.refresh, mask_format=args.mask_format,
+                compress=not args.no_gzip, gzip_level=args.gzip_level, gzip_threads=args.gzip_threads, frozen=not args.no_frozen,
+                precision=args.precision, backend=args.backend, geometry_cache_mb=args.geometry_cache,
+                outputs=args.outputs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Segment the hippocampus (and brain mask) of T1 images")
+    parser.add_argument("fnames", nargs="*", metavar="T1", help="input NIfTI image(s)")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes, each with its own copy of the networks")
+    parser.add_argument("--threads-per-worker", type=int, default=0, help="torch CPU threads per worker (default: all CPU threads, shared among workers)")
+    parser.add_argument("--batch-size", type=int, default=1, metavar="K", help="segment K subjects at once, as a single batch through each network")
+    parser.add_argument("--prefetch", type=int, default=0, metavar="N", help="read and decode the next N images, and write the outputs, in background threads (single process mode)")
+    parser.add_argument("--resume", action="store_true", help="skip the subjects whose masks and volumes csv are already written (and newer than the input), still listing them in the summary table")
+    parser.add_argument("--profile", metavar="FILE", help="append the time, CPU time and memory of each processing stage to FILE, one JSON line per subject")
+    add_pipeline_arguments(parser)
+    args = parser.parse_args(argv)
+    settings = pipeline_settings(args)
+
+    fnames = list(args.fnames)
+    if len(fnames) == 0:
+      try:
+        from GetFilename import GetFilename
+        fnames.append(GetFilename())
+      except:
+        print("Need to pass one or more T1 image filename as argument")
+        sys.exit(1)
+
+    batch_size = max(1, args.batch_size)
+    workers = max(1, args.workers)
+    threads = args.threads_per_worker
+    if workers > 1 and not threads:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+
+    # with --resume, subjects whose outputs are already written are only added to the summary table
+    done = {}
+    if args.resume:
+        for i, fname in enumerate(fnames):
+            vols = completed_volumes(fname, args.mask_format, not args.no_gzip, args.outputs)
+            if vols is not None:
+                print("Skipping %s (already processed)" % fname)
+                done[i] = (fname,) + vols
+    todo = [i for i in range(len(fnames)) if i not in done]
+    torun = [fnames[i] for i in todo]
+    workers = max(1, min(workers, (len(torun) + batch_size - 1) // batch_size))
+
+    processed = [] # one report row (or None) per file of torun
+    row = lambda fname, res: None if res is None else (fname, res["eTIV"], res["hippoL"], res["hippoR"])
+    if not torun:
+        pass
+    elif workers == 1:
+        if threads:
+            print("Using %d CPU threads" % threads)
+            torch.set_num_threads(threads)
+        else:
+            print("Using all available CPU threads")
+
+        pipeline = HippoDeepPipeline(profiler=args.profile and StageProfiler(args.profile, overlapped=args.prefetch > 0), **settings)
+        if args.prefetch > 0:
+            # read/decode ahead and write behind, overlapping the gzip I/O with inference
+            writer = AsyncWriter(args.prefetch)
+            try:
+                for chunk in chunks(prefetch_images(torun, max(args.prefetch, batch_size)), batch_size):
+                    names, imgs = zip(*chunk)
+                    processed.extend(map(row, names, run_batch(pipeline, names, "report" in args.outputs, imgs, writer)))
+            finally:
+                writer.close()
+        else:
+            for chunk in chunks(torun, batch_size):
+                processed.extend(map(row, chunk, run_batch(pipeline, chunk, "report" in args.outputs)))
+    else:
+        print("Using %d workers of %d CPU threads" % (workers, threads))
+        if args.precision == "int8" and args.backend == "torch" and load_int8([params_head, params_affine, params_hippo]) is None:
+            # calibrate once here, rather than in each worker
+            print("Calibrating the int8 networks (run hippodeep_precision.py --export to do it once for all)")
+            try:
+                export_int8()
+            except OSError as e:
+                print(" *** Warning: can't save the int8 networks (%s), each worker calibrates them" % e)
+        # spawn (rather than fork) as torch's thread pools don't survive a fork
+        with multiprocessing.get_context("spawn").Pool(workers, initializer=_init_worker, initargs=(threads, args.profile, settings, "report" in args.outputs)) as pool:
+            # imap keeps the subjects order, so the logs and the summary table are deterministic
+            for rows, log in pool.imap(_run_worker, chunks(torun, batch_size)):
+                sys.stdout.write(log)
+                sys.stdout.flush()
+                processed.extend(rows)
+            pool.close()
+            pool.join()
+
+    rows = dict(done)
+    rows.update(zip(todo, processed))
+    allsubjects_scalar_report = [rows[i] for i in range(len(fnames)) if rows[i] is not None]
+
+    print("Peak memory used (Gb) " + str(round(peak_memory_gb(),2)))
+
+    print("Done")
+
+    if len(fnames) > 1:
+        outfilename = (os.path.dirname(fnames[-1]) or ".") + "/all_subjects_hippo_report.csv"
+        txt_entries = ["%s,%4f,%4f,%4f\n" % s for s in allsubjects_scalar_report]
+        open(outfilename, "w").writelines( [ "filename,eTIV,hippoL,hippoR\n" ] + txt_entries)
+        print("Volumes of every subjects saved as " + outfilename)
+
+    #pause for windows to be able to see messages
+    if sys.platform=="win32": os.system("pause") # windows
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support() # for the pyInstaller executable
+    main()